@@ -0,0 +1,474 @@
+"""
+Aggregation of raw PTC trip records into the wp_* tables.
+
+    python aggregate.py TRIPS WARDS --period 2018-09 [--out DIR] [--snapshot]
+                        [--hotspots] [--top N] [--chunk-rows N]
+
+Computes the nine frames the dashboard reads (see schema.py) for one report
+period from the trip records themselves, so a new period doesn't need the
+upstream wp_* views. The records are read in chunks of
+--chunk-rows and folded into fixed-size count arrays (trips by area and hour
+of the week, and by origin, destination and hour of the week), so memory
+depends on the number of areas, not of trips.
+
+TRIPS is a directory of parts, or a single part. A part is either a directory
+holding one .npy file per column, as snapshot.py writes them (memory-mapped,
+so only the chunk being counted is read), or a Parquet file (needs pyarrow).
+The columns are
+
+    pickup_datetime   local time, datetime64 (or epoch seconds)
+    pickup_ward       area the trip starts in, 1 to N (anything else: outside)
+    dropoff_ward      area the trip ends in, likewise
+    distance_km       trip length
+    pickup_lon, pickup_lat, dropoff_lon, dropoff_lat
+                      trip ends in degrees, read with --hotspots (a part
+                      without them isn't binned)
+
+Only the trips of the period's month and of the month growth is measured
+from (periods.growth_base) are counted; other records are skipped.
+
+WARDS is a CSV with a row per area: ward (1 to N), name, pop, area_ha and
+traffic_vkt (vehicle-km travelled by all traffic on an average day, the
+denominator of the proportion of traffic by PTCs). A trip's distance counts
+half towards its pick-up area and half towards its drop-off area.
+
+The frames are written as CSVs in the fixtures layout, <out>/wp_*.csv
+(<out>/201903/ for later periods; <out> defaults to aggregated/, not the
+checked-in fixtures/), so WP_FIXTURES=<out> serves them, and with
+--snapshot also as the period's snapshot, which the dashboard loads without
+going to the database. With --hotspots the pick-up and drop-off points of each
+ward are binned into the period's hotspot map grid (hotspots.py), and with
+--boundaries GEOJSON each ward is outlined on its map from its (Multi)Polygon
+feature, identified by a `ward` property (1 to N); without it the outline
+follows the ward's trip ends.
+"""
+import argparse
+import calendar
+import collections
+import glob
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import data
+import hotspots
+import periods
+import schema
+import snapshot
+
+LOGGER = logging.getLogger(__name__)
+
+COLUMNS = ['pickup_datetime', 'pickup_ward', 'dropoff_ward', 'distance_km']
+POINTS = ['pickup_lon', 'pickup_lat', 'dropoff_lon', 'dropoff_lat']
+HOURS = 7 * 24  # hours of the week, Monday 0h first
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
+        'Sunday']
+
+
+def _parts(path):
+    """The parts (column directories or Parquet files) under path."""
+    if path.endswith('.parquet') or os.path.exists(
+            os.path.join(path, COLUMNS[0] + '.npy')):
+        return [path]
+    parts = sorted(glob.glob(os.path.join(path, '*.parquet')) +
+                   [os.path.dirname(p) for p in
+                    glob.glob(os.path.join(path, '*', COLUMNS[0] + '.npy'))])
+    if not parts:
+        raise SystemExit('No trip records found in {}'.format(path))
+    return parts
+
+
+def read_chunks(path, chunk_rows=1000000, optional=()):
+    """
+    Yields {column: array} chunks of at most chunk_rows trips from every part
+    under path, with the COLUMNS and the `optional` columns, which are NaN in
+    a part that doesn't have them.
+    """
+    for part in _parts(path):
+        if part.endswith('.parquet'):
+            if pyarrow is None:
+                raise SystemExit('Reading {} needs pyarrow'.format(part))
+            reader = pyarrow.parquet.ParquetFile(part)
+            names = set(reader.schema_arrow.names)
+            found = COLUMNS + [col for col in optional if col in names]
+            for batch in reader.iter_batches(batch_size=chunk_rows,
+                                             columns=found):
+                chunk = {col: batch.column(col).to_numpy(zero_copy_only=False)
+                         for col in found}
+                yield _fill(chunk, optional)
+            continue
+        arrays = {col: np.load(os.path.join(part, col + '.npy'), mmap_mode='r')
+                  for col in COLUMNS + list(optional)
+                  if col in COLUMNS or
+                  os.path.exists(os.path.join(part, col + '.npy'))}
+        rows = len(arrays[COLUMNS[0]])
+        for start in range(0, rows, chunk_rows):
+            chunk = {col: np.asarray(values[start:start + chunk_rows])
+                     for col, values in arrays.items()}
+            yield _fill(chunk, optional)
+
+
+def _fill(chunk, optional):
+    rows = len(chunk[COLUMNS[0]])
+    for col in optional:
+        if col not in chunk:
+            chunk[col] = np.full(rows, np.nan)
+    return chunk
+
+
+def write_part(columns, directory):
+    """Writes {column: array} as a part of trip records that read_chunks reads."""
+    os.makedirs(directory, exist_ok=True)
+    for col in COLUMNS + [col for col in POINTS if col in columns]:
+        np.save(os.path.join(directory, col + '.npy'), np.asarray(columns[col]))
+
+
+class Counts(object):
+    """
+    Trip counts of the period's month (index 1) and the growth base month
+    (index 0), by area (0 is outside) and hour of the week. Only the period's
+    month is counted by origin and destination, for distance, and (with
+    points) by ward and hotspot grid cell.
+    """
+
+    def __init__(self, period, wards, points=False):
+        self.months = np.array([periods.growth_base(period), period],
+                               dtype='datetime64[M]')
+        self.areas = wards + 1
+        self.pickups = np.zeros((2, self.areas, HOURS), dtype=np.int64)
+        self.dropoffs = np.zeros((2, self.areas, HOURS), dtype=np.int64)
+        self.od = np.zeros((HOURS, self.areas, self.areas), dtype=np.int64)
+        self.km = np.zeros(self.areas)
+        self.points = (np.zeros(self.areas * hotspots.CELLS, dtype=np.uint32)
+                       if points else None)
+        self.trips = 0
+
+    def _area(self, values):
+        values = values.astype(np.int64)
+        values[(values < 1) | (values >= self.areas)] = 0
+        return values
+
+    def add(self, chunk):
+        times = chunk['pickup_datetime']
+        if times.dtype.kind != 'M':
+            times = times.astype('datetime64[s]')
+        month = times.astype('datetime64[M]')
+        index = np.full(len(times), -1)
+        index[month == self.months[0]] = 0
+        index[month == self.months[1]] = 1
+        keep = index >= 0
+        if not keep.all():
+            times, index = times[keep], index[keep]
+            chunk = {col: values[keep] for col, values in chunk.items()}
+        self.trips += len(times)
+
+        days = times.astype('datetime64[D]')
+        # 1970-01-01 was a Thursday
+        weekday = (days.astype(np.int64) + 3) % 7
+        hour = (times - days) // np.timedelta64(1, 'h')
+        how = weekday * 24 + hour
+        pickup = self._area(chunk['pickup_ward'])
+        dropoff = self._area(chunk['dropoff_ward'])
+
+        size = 2 * self.areas * HOURS
+        self.pickups += np.bincount((index * self.areas + pickup) * HOURS + how,
+                                    minlength=size).reshape(self.pickups.shape)
+        self.dropoffs += np.bincount((index * self.areas + dropoff) * HOURS + how,
+                                     minlength=size).reshape(self.dropoffs.shape)
+
+        now = index == 1
+        pickup, dropoff, how = pickup[now], dropoff[now], how[now]
+        self.od += np.bincount((how * self.areas + pickup) * self.areas + dropoff,
+                               minlength=self.od.size).reshape(self.od.shape)
+        half = chunk['distance_km'][now].astype(np.float64) / 2
+        self.km += (np.bincount(pickup, weights=half, minlength=self.areas) +
+                    np.bincount(dropoff, weights=half, minlength=self.areas))
+
+        if self.points is not None:
+            # each end of a trip counts towards its own ward's grid
+            keys = []
+            for area, lon, lat in ((pickup, 'pickup_lon', 'pickup_lat'),
+                                   (dropoff, 'dropoff_lon', 'dropoff_lat')):
+                cell = hotspots.cells(chunk[lon][now], chunk[lat][now])
+                inside = (cell >= 0) & (area > 0)
+                keys.append(area[inside] * hotspots.CELLS + cell[inside])
+            keys, n = np.unique(np.concatenate(keys), return_counts=True)
+            self.points[keys] += n.astype(np.uint32)
+
+
+def hour_label(how):
+    """Hour of the week -> 'Friday 8 p.m.', in AP style."""
+    day, hour = DAYS[how // 24], how % 24
+    if hour == 0:
+        return '{} midnight'.format(day)
+    if hour == 12:
+        return '{} noon'.format(day)
+    return '{} {} {}'.format(day, (hour - 1) % 12 + 1,
+                             'a.m.' if hour < 12 else 'p.m.')
+
+
+def _occurrences(month):
+    """How many times each hour of the week occurs in a month."""
+    year, number = int(str(month)[:4]), int(str(month)[5:7])
+    days = calendar.monthrange(year, number)[1]
+    first = calendar.weekday(year, number, 1)
+    per_day = np.bincount((first + np.arange(days)) % 7, minlength=7)
+    return np.repeat(per_day, 24)
+
+
+def _days(month):
+    return len(np.arange(month, month + 1, dtype='datetime64[D]'))
+
+
+def _top(counts, n, names):
+    """
+    Top n destinations of each row of counts (area x area).
+    Outputs:
+    (names, counts) arrays of shape (areas, n); None / 0 past the last
+    destination with any trips
+    """
+    order = np.argsort(-counts, axis=1, kind='stable')[:, :n]
+    top = np.take_along_axis(counts, order, axis=1)
+    dests = np.asarray(names, dtype=object)[order]
+    dests[top == 0] = None
+    return dests, top
+
+
+def _keys(n):
+    return ['w{}'.format(i) for i in range(1, n + 1)]
+
+
+def _dest_frame(dests, trips, share):
+    n = dests.shape[1]
+    columns = collections.OrderedDict([('ward', _keys(len(dests)))])
+    for prefix, values in (('dest', dests), ('trips', trips), ('pct', share)):
+        for i in range(n):
+            columns['{}{}'.format(prefix, i + 1)] = values[:, i]
+    return pd.DataFrame(columns)
+
+
+def _percent(part, whole, decimals=1):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(100.0 * part / whole, decimals)
+
+
+def build_frames(counts, wards, top=5):
+    """
+    The nine wp_* frames from the trip counts.
+    Inputs:
+    counts: Counts of every trip record
+    wards: the WARDS table, one row per area in ward order
+    top: number of destinations listed per area
+
+    Outputs:
+    dict of frame name -> DataFrame, with the columns of the wp_* tables
+    """
+    n = len(wards)
+    ids = np.arange(1, n + 1)
+    keys = _keys(n)
+    names = wards['name'].tolist()
+    base, now = counts.months
+    occurrences = _occurrences(now)
+    zero = np.zeros(n)
+    frames = collections.OrderedDict()
+
+    pickups = counts.pickups[:, 1:]
+    dropoffs = counts.dropoffs[:, 1:]
+    trips = pickups.sum(axis=2)
+    before = trips[0] / _days(base)
+    after = trips[1] / _days(now)
+
+    frames['df_rank'] = pd.DataFrame({
+        'ward': ids, 'avg trips/day': np.round(after).astype(np.int64),
+        'y': zero})
+    frames['df_vkt'] = pd.DataFrame({
+        'ward': ids,
+        'prop_ptc_traffic': _percent(counts.km[1:] / _days(now),
+                                     wards['traffic_vkt'].values),
+        'y': zero})
+    frames['df_pop'] = pd.DataFrame({'ward': ids, 'pop': wards['pop'].values,
+                                     'y': zero})
+    frames['df_popd'] = pd.DataFrame({
+        'ward': ids,
+        'pop_density': np.round(wards['pop'].values /
+                                wards['area_ha'].values, 1),
+        'y': zero})
+
+    # the city bars are the average ward
+    before = np.append(before, before.mean())
+    after = np.append(after, after.mean())
+    frames['df_growth'] = pd.DataFrame(collections.OrderedDict([
+        ('ward', keys + ['city']),
+        (pd.Timestamp(base).strftime('%b%Y'), np.round(before)),
+        (pd.Timestamp(now).strftime('%b%Y'), np.round(after)),
+        ('percent_change', _percent(after - before, before))]))
+
+    # share of a typical week's pick-ups in each hour of the week
+    weekly = pickups[1] / occurrences
+    frames['df_dow_ts'] = pd.DataFrame(collections.OrderedDict(
+        [('city', _percent(weekly.sum(axis=0), weekly.sum(), 3))] +
+        [(key, _percent(row, row.sum(), 3)) for key, row in zip(keys, weekly)]))
+
+    # busiest hour of the week, by pick-ups and drop-offs on an average day
+    volume = (pickups[1] + dropoffs[1]) / occurrences
+    busiest = volume.argmax(axis=1)
+    per_day = occurrences[busiest]
+    busy_pickups = np.round(pickups[1][ids - 1, busiest] / per_day).astype(np.int64)
+    busy_dropoffs = np.round(dropoffs[1][ids - 1, busiest] / per_day).astype(np.int64)
+    frames['df_busiest_pudo_info'] = pd.DataFrame(collections.OrderedDict([
+        ('ward', keys),
+        ('div1', [hour_label(how) for how in busiest]),
+        ('div2', ['{:,} trips'.format(total)
+                  for total in busy_pickups + busy_dropoffs]),
+        ('Observations', np.where(
+            busy_pickups > busy_dropoffs,
+            'Pick-ups outnumber drop-offs during the busiest hour.',
+            'Drop-offs outnumber pick-ups during the busiest hour.')),
+        ('Pickups', busy_pickups),
+        ('Dropoffs', busy_dropoffs)]))
+
+    # destinations of all trips, and of the busiest hour's
+    od = counts.od[:, 1:, 1:]
+    dests, top_trips = _top(od.sum(axis=0), top, names)
+    df = _dest_frame(dests, np.round(top_trips / _days(now)).astype(np.int64),
+                     _percent(top_trips, trips[1][:, None]))
+    df['Observations'] = [
+        'Trips most often stay within the ward.' if dest == name else
+        'Trips most often end in {}.'.format(dest)
+        for dest, name in zip(dests[:, 0], names)]
+    frames['df_top5_dest'] = df
+
+    dests, top_trips = _top(od[busiest, ids - 1], top, names)
+    frames['df_busiest_top5_dest'] = _dest_frame(
+        dests, np.round(top_trips / per_day[:, None]).astype(np.int64),
+        _percent(top_trips, pickups[1][ids - 1, busiest][:, None]))
+    return frames
+
+
+def read_wards(path):
+    """The WARDS table, checked to number its areas 1 to N."""
+    wards = pd.read_csv(path).sort_values('ward').reset_index(drop=True)
+    missing = [col for col in ['ward', 'name', 'pop', 'area_ha', 'traffic_vkt']
+               if col not in wards.columns]
+    if missing:
+        raise SystemExit('{}: missing columns {}'.format(path, missing))
+    if wards['ward'].tolist() != list(range(1, len(wards) + 1)):
+        raise SystemExit('{}: wards must be numbered 1 to N'.format(path))
+    return wards
+
+
+def read_boundaries(path, n):
+    """
+    The hotspot grid cells inside each of the n wards of a GeoJSON file, as an
+    array (n, ROWS, COLS) of bools (see hotspots.rasterize).
+    """
+    with open(path) as f:
+        features = json.load(f)['features']
+    masks = np.zeros((n, hotspots.ROWS, hotspots.COLS), dtype=bool)
+    for feature in features:
+        ward = int(feature['properties']['ward'])
+        if not 1 <= ward <= n:
+            raise SystemExit('{}: ward {} is not 1 to {}'.format(path, ward, n))
+        geometry = feature['geometry']
+        polygons = (geometry['coordinates'] if geometry['type'] == 'MultiPolygon'
+                    else [geometry['coordinates']])
+        masks[ward - 1] |= hotspots.rasterize(
+            [ring for polygon in polygons for ring in polygon])
+    return masks
+
+
+def aggregate(trips, wards, period, top=5, chunk_rows=1000000, points=False):
+    """
+    Computes the wp_* frames of `period` from the trip records under `trips`.
+    Inputs:
+    trips: directory (or part) of trip records, see read_chunks
+    wards: the WARDS table, see read_wards
+    points: also bin the trip ends, see write_hotspots
+
+    Outputs:
+    (dict of frame name -> DataFrame as build_frames, Counts)
+    """
+    counts = Counts(period, len(wards), points)
+    start = time.time()
+    records = 0
+    for chunk in read_chunks(trips, chunk_rows, POINTS if points else ()):
+        counts.add(chunk)
+        records += len(chunk[COLUMNS[0]])
+    elapsed = time.time() - start
+    LOGGER.info('Counted %d of %d trip records in %.1fs (%.0f records/s)',
+                counts.trips, records, elapsed, records / max(elapsed, 1e-9))
+    return build_frames(counts, wards, top), counts
+
+
+def write_hotspots(counts, period, masks=None):
+    """
+    Saves the binned trip ends as the period's hotspot map grid, with the
+    wards' cells from `read_boundaries` when given.
+    """
+    grids = counts.points.reshape(counts.areas, hotspots.ROWS, hotspots.COLS)
+    return hotspots.write(grids[1:], _keys(counts.areas - 1), period,
+                          masks=masks)
+
+
+def write(frames, period, out_dir=None, to_snapshot=False):
+    """
+    Validates the frames against schema.py and writes them as CSVs in the
+    fixtures layout under out_dir and/or as the period's snapshot.
+    """
+    loaded = collections.OrderedDict(
+        (name, schema.apply(name, frames[name])) for name in data.TABLES)
+    if out_dir:
+        directory = os.path.join(out_dir, periods.suffix(period))
+        os.makedirs(directory, exist_ok=True)
+        for name, table in data.TABLES.items():
+            frames[name].to_csv(
+                os.path.join(directory, table.split('.')[-1] + '.csv'),
+                index=False)
+        LOGGER.info('Wrote %d tables to %s', len(frames), directory)
+    if to_snapshot:
+        # there is nothing in the database to refresh it from
+        snapshot.write(loaded, data.data_version(loaded, period),
+                       data.snapshot_dir(period), expires=False)
+    return loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trips', help='directory of trip records')
+    parser.add_argument('wards', help='CSV of the areas: ward, name, pop, '
+                                      'area_ha, traffic_vkt')
+    parser.add_argument('--period', default=periods.default(),
+                        help='report month, e.g. 2018-09 (default: the '
+                             'latest of WP_PERIODS)')
+    parser.add_argument('--out', default='aggregated',
+                        help='where the CSVs go (default aggregated/)')
+    parser.add_argument('--snapshot', action='store_true',
+                        help="also write the period's snapshot")
+    parser.add_argument('--hotspots', action='store_true',
+                        help='also bin the trip ends for the hotspot maps')
+    parser.add_argument('--boundaries',
+                        help='GeoJSON of the ward boundaries to outline on '
+                             'the hotspot maps (a ward property, 1 to N)')
+    parser.add_argument('--top', type=int, default=5,
+                        help='destinations per ward (default 5)')
+    parser.add_argument('--chunk-rows', type=int, default=1000000,
+                        help='trip records counted at a time (default 1000000)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    wards = read_wards(args.wards)
+    masks = (read_boundaries(args.boundaries, len(wards))
+             if args.hotspots and args.boundaries else None)
+    frames, counts = aggregate(args.trips, wards, args.period, args.top,
+                               args.chunk_rows, args.hotspots)
+    write(frames, args.period, args.out, args.snapshot)
+    if args.hotspots:
+        write_hotspots(counts, args.period, masks)
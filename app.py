@@ -1,70 +1,55 @@
+import logging
 import os
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import pandas as pd
-import pandas.io.sql as pandasql
-import plotly.graph_objs as go
-from psycopg2 import connect
-
-# for serving static images
-# https://github.com/plotly/dash/issues/71
-import base64
 
 # bootstrap
 import dash_bootstrap_components as dbc
 
+import cache
+import compress
+import data
+import hotspots
+import images
+import metrics
+import periods
+import profiling
+import store
+import warmup
+
+logging.basicConfig(level=logging.INFO)
+
 ###################################################################################################
 #                                                                                                 #
 #                                       Data Fetching                                             #
 #                                                                                                 #
 ###################################################################################################
 
-database_url = os.getenv("DATABASE_URL")
-if database_url is not None:
-    con = connect(database_url)
-else:
-    import configparser
-    CONFIG = configparser.ConfigParser()
-    CONFIG.read('config.cfg')
-    dbset = CONFIG['DBSETTINGS']
-    con = connect(**dbset)
-
-# ** ward-stats **
-df_rank = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_avg_daily_trips
-                         ''', con)
-
-df_vkt = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_vkt
-                         ''', con)
-
-df_pop = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_pop
-                         ''', con)
-df_popd = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_popdensity
-                         ''', con)
-
-df_growth = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_growth
-                         ''', con)
-
-df_dow_ts = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_dow_timeseries
-                         ''', con)
-
-df_busiest_pudo_info = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_busiest_pudo_info
-                         ''', con)
-
-df_top5_dest = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_top5_dest
-                         ''', con)
-
-df_busiest_top5_dest = pandasql.read_sql('''
-                         SELECT * FROM cnangini.wp_busiest_top5_dest
-                         ''', con)
+frames, version = data.load_frames()
+data.swap(data.build_dataset(frames, version))
+
+# ** ward profile store **
+# one record per ward so the callbacks don't scan the frames on every change.
+# Reads go through data.current() so a background refresh can swap in new data.
+def frame(name):
+    with metrics.stage('lookup'):
+        return data.current()['frames'][name]
+
+def ward_profile(value):
+    with metrics.stage('lookup'):
+        return data.current()['wards'][store.ward_id(value)]
+
+def city_profile():
+    with metrics.stage('lookup'):
+        return data.current()['city']
+
+def number_line(field):
+    with metrics.stage('lookup'):
+        return data.current()['lines'][field]
+
+def current_period():
+    return data.current()['period']
 
 ###################################################################################################
 #                                                                                                 #
@@ -122,7 +107,9 @@ maptext_dict = {
 
 # -----------------------------------------------------------------------
 # App code
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# compress.py does the compression, not Dash's Flask-Compress
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
+                compress=False)
 
 server = app.server
 
@@ -135,6 +122,35 @@ server = app.server
 # Something for heroku
 server.secret_key = os.environ.get('SECRET_KEY', 'my-secret-key')
 
+# gzip/brotli for callback responses, scripts and stylesheets
+if os.environ.get('WP_COMPRESS', '1') != '0':
+    compress.register(server, static_prefixes=[
+        app.config.routes_pathname_prefix + '_dash-component-suites/',
+        app.config.routes_pathname_prefix + 'assets/',
+        app.config.routes_pathname_prefix + '_favicon.ico',
+        # served with an ETag by cache.register_page
+        app.config.routes_pathname_prefix + '_dash-layout',
+        app.config.routes_pathname_prefix + '_dash-dependencies'
+    ])
+
+# Request counts and timings on /metrics (Prometheus text format)
+if os.environ.get('WP_METRICS', '1') != '0':
+    metrics.register(server, wards=ward_dict)
+metrics.gauge('wp_data_version_info', (('version', version),), 1)
+
+# cProfile a sample of requests (WP_PROFILE_RATE) or on request (WP_PROFILE_TOKEN)
+profiling.register(server)
+
+# Each request sees one data set even if a refresh swaps in a new one meanwhile
+server.before_request(data.pin)
+server.teardown_request(data.unpin)
+
+# Trip maps and inset icons, served from fingerprinted URLs
+images.register(server)
+# Hotspot maps drawn from the period's trips, from versioned URLs
+hotspots.register(server)
+warmup.register(server)
+
 app.layout = html.Div([
     dbc.Row(
         [
@@ -146,15 +162,25 @@ app.layout = html.Div([
                 ),
                 html.Div(
                     children='September 2018',
+                    id='report-period',
                     className='subtitle'
                 )
             ], width=6, align="left"),
 
             dbc.Col([
-                html.Img(
-                    id='map-icon',
-                    alt='Map of PTC activity'
-            )], width=2),
+                html.Picture([
+                    html.Source(
+                        id='map-icon-webp',
+                        type='image/webp',
+                        sizes='(max-width: 768px) 33vw, 160px'
+                    ),
+                    html.Img(
+                        id='map-icon',
+                        alt='Map of PTC activity',
+                        sizes='(max-width: 768px) 33vw, 160px'
+                    )
+                ])
+            ], width=2),
 
             dbc.Col([
                 html.Div([
@@ -191,7 +217,19 @@ app.layout = html.Div([
                             value='w1'
                         )
                     ]
-                )
+                ),
+                # only shown when there is more than one period to pick
+                html.Div([
+                    html.Label('Select period', id='period-label'),
+                    dcc.Dropdown(
+                        id='period-dropdown',
+                        options=[{'label': periods.label(p), 'value': p}
+                                 for p in periods.available()],
+                        value=periods.default(),
+                        clearable=False
+                    )
+                ], id='period-selector',
+                   style={} if len(periods.available()) > 1 else {'display': 'none'})
         ], width=4, align="center")
     ]),
 
@@ -252,9 +290,18 @@ app.layout = html.Div([
             ], width=3, align="left", className='lines-div'),
 
             dbc.Col([
-                html.Img(
-                    id='map-trips'
-            )], width=8, className='tripmap-div')
+                html.Picture([
+                    html.Source(
+                        id='map-trips-webp',
+                        type='image/webp',
+                        sizes='(max-width: 768px) 100vw, 66vw'
+                    ),
+                    html.Img(
+                        id='map-trips',
+                        sizes='(max-width: 768px) 100vw, 66vw'
+                    )
+                ])
+            ], width=8, className='tripmap-div')
         ]
     ),
 
@@ -360,6 +407,7 @@ app.layout = html.Div([
             dbc.Col([
                 html.Div(
                 children='* September Daily Average',
+                id='dow-footnote',
                 className='growth-bar-footnote'
             )], width=3),
             dbc.Col([
@@ -434,6 +482,7 @@ app.layout = html.Div([
             dbc.Col([
                 html.Div(
                     children='Busiest Hour (Sept 2016 – Sept 2018)',
+                    id='busiest-hour-title',
                     className='myH3'
             ),
             html.Div(
@@ -484,59 +533,46 @@ app.layout = html.Div([
 
 # -----------------------------------------------------------------------
 # UI Handler - text updates for different sections
-@app.callback(
-    [dash.dependencies.Output('ward-title', 'children'),
-    dash.dependencies.Output('dailytrip-value', 'children'),
-    dash.dependencies.Output('vkt-value', 'children'),
-    dash.dependencies.Output('pop_val', 'children'),
-    dash.dependencies.Output('popdensity-value', 'children')],
-    [dash.dependencies.Input('ward-dropdown', 'value')]
-)
 def update_stats(value):
-    rank_val = df_rank.loc[df_rank['ward']==int(value[1:]), 'avg trips/day'].values[0]
-    vkt_val = df_vkt.loc[df_vkt['ward']==int(value[1:]), 'prop_ptc_traffic'].values[0]
-    pop_val = df_pop.loc[df_pop['ward']==int(value[1:]), 'pop'].values[0]
-    popd_val = df_popd.loc[df_popd['ward']==int(value[1:]), 'pop_density'].values[0]
+    profile = ward_profile(value)
+    rank_val = profile['avg_trips']
+    vkt_val = profile['prop_ptc_traffic']
+    pop_val = profile['pop']
+    popd_val = profile['pop_density']
 
     return 'Ward {}'.format(value[1:] + ': ' + ward_dict[value]), \
     '{}'.format(rank_val), \
-    '{}'.format(vkt_val + '%'), \
+    '{}%'.format(vkt_val), \
     '{}'.format(pop_val), \
     '{}'.format(popd_val)
 
-@app.callback(
-    dash.dependencies.Output('map-caption', 'children'),
-    [dash.dependencies.Input('ward-dropdown', 'value')]
-)
 def update_mapcaption(value):
     return '{}'.format(maptext_dict[value])
 
-@app.callback(
-    [dash.dependencies.Output('growth-pc-ward', 'children'),
-     dash.dependencies.Output('growth-pc-city', 'children')],
-    [dash.dependencies.Input('ward-dropdown', 'value')]
-)
 def update_growth(value):
     # Percent growth change in ward and in city
-    grow_pcval_ward = '+' + repr(df_growth.loc[df_growth['ward']==value, 'percent_change'].values[0]) + '%'
-    grow_pcval_city = '+' + repr(df_growth.loc[df_growth['ward']=='city', 'percent_change'].values[0]) + '%'
+    grow_pcval_ward = '+' + repr(ward_profile(value)['growth_pc']) + '%'
+    grow_pcval_city = '+' + repr(city_profile()['growth_pc']) + '%'
 
     return '{}'.format(grow_pcval_ward), \
     '{}'.format(grow_pcval_city)
 
-@app.callback(
-    [dash.dependencies.Output('top5-caption', 'children'),
-     dash.dependencies.Output('busiest-title', 'children'),
-     dash.dependencies.Output('total-trips', 'children'),
-     dash.dependencies.Output('busiest-obs-caption', 'children')],
-    [dash.dependencies.Input('ward-dropdown', 'value')]
-)
+def update_period_texts(value):
+    # Report month, and the two years growth is measured over
+    period = current_period()
+    base = periods.growth_base(period)
+
+    return periods.label(period), \
+    'Busiest Hour ({} – {})'.format(periods.short(base), periods.short(period)), \
+    '* {} Daily Average'.format(periods.month(period))
+
 def update_busy_texts(value):
     # Busiest hour texts
-    busiest_hr = df_busiest_pudo_info.loc[df_busiest_pudo_info['ward']==value, 'div1'].values[0]
-    busiest_tot = df_busiest_pudo_info.loc[df_busiest_pudo_info['ward']==value, 'div2'].values[0]
-    busiest_obs = df_busiest_pudo_info.loc[df_busiest_pudo_info['ward']==value, 'Observations'].values[0]
-    busiest_top5 = df_top5_dest.loc[df_top5_dest['ward']==value, 'Observations'].values[0]
+    profile = ward_profile(value)
+    busiest_hr = profile['busiest_hr']
+    busiest_tot = profile['busiest_tot']
+    busiest_obs = profile['busiest_obs']
+    busiest_top5 = profile['top5_obs']
 
     return '{}'.format(busiest_top5), \
     '{}'.format(busiest_hr), \
@@ -546,19 +582,24 @@ def update_busy_texts(value):
 # -----------------------------------------------------------------------
 # ** Map icon inset **
 def display_map_icon(value):
-    image_icon = 'img/inset/inset_' + value + '.png'
-    encoded_icon = base64.b64encode(open(image_icon, 'rb').read())
-    return 'data:image/png;base64,{}'.format(encoded_icon.decode())
+    # full-size fallback, then the resized variants for srcSet (if built)
+    image_icon = 'inset/inset_' + value + '.png'
+    return images.url(image_icon), \
+    images.srcset(image_icon, 'image/png'), \
+    images.srcset(image_icon, 'image/webp')
 
 # -----------------------------------------------------------------------
 # WARD PROFILE
+# Figure traces are plain dicts, which skip plotly's per-property validation;
+# tests/test_figures.py checks them against the validated graph_objs.
 # ** Avg trips/day ranking number line **
 def create_daily_rank_scatter(value):
     return {
         'data': [
-            go.Scatter(
-                x=df_rank['avg trips/day'],
-                y=df_rank['y'],
+            dict(
+                type='scatter',
+                x=number_line('avg_trips')['x'],
+                y=number_line('avg_trips')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -569,9 +610,10 @@ def create_daily_rank_scatter(value):
                 name='other wards'
             ),
             # ward
-            go.Scatter(
-                x=df_rank.loc[df_rank['ward']==int(value[1:]), 'avg trips/day'],
-                y=df_rank['y'],
+            dict(
+                type='scatter',
+                x=[ward_profile(value)['avg_trips']],
+                y=number_line('avg_trips')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -615,9 +657,10 @@ def create_daily_rank_scatter(value):
 def create_pop_scatter(value):
     return {
         'data': [
-            go.Scatter(
-                x=df_vkt['prop_ptc_traffic'],
-                y=df_vkt['y'],
+            dict(
+                type='scatter',
+                x=number_line('prop_ptc_traffic')['x'],
+                y=number_line('prop_ptc_traffic')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -627,9 +670,10 @@ def create_pop_scatter(value):
                 },
                 name='other wards'
             ),
-            go.Scatter(
-                x=df_vkt.loc[df_vkt['ward']==int(value[1:]), 'prop_ptc_traffic'],
-                y=df_vkt['y'],
+            dict(
+                type='scatter',
+                x=[ward_profile(value)['prop_ptc_traffic']],
+                y=number_line('prop_ptc_traffic')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -672,9 +716,10 @@ def create_pop_scatter(value):
 def create_pop_density_scatter(value):
     return {
         'data': [
-            go.Scatter(
-                x=df_pop['pop'],
-                y=df_pop['y'],
+            dict(
+                type='scatter',
+                x=number_line('pop')['x'],
+                y=number_line('pop')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -684,9 +729,10 @@ def create_pop_density_scatter(value):
                 },
                 name='other wards'
             ),
-            go.Scatter(
-                x=df_pop.loc[df_pop['ward']==int(value[1:]), 'pop'],
-                y=df_pop['y'],
+            dict(
+                type='scatter',
+                x=[ward_profile(value)['pop']],
+                y=number_line('pop')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -729,9 +775,10 @@ def create_pop_density_scatter(value):
 def create_pop_density_scatter(value):
     return {
         'data': [
-            go.Scatter(
-                x=df_popd['pop_density'],
-                y=df_popd['y'],
+            dict(
+                type='scatter',
+                x=number_line('pop_density')['x'],
+                y=number_line('pop_density')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -741,9 +788,10 @@ def create_pop_density_scatter(value):
                 },
                 name='other wards'
             ),
-            go.Scatter(
-                x=df_popd.loc[df_popd['ward']==int(value[1:]), 'pop_density'],
-                y=df_popd['y'],
+            dict(
+                type='scatter',
+                x=[ward_profile(value)['pop_density']],
+                y=number_line('pop_density')['y'],
                 mode='markers',
                 marker= {
                     'opacity': 1,
@@ -783,40 +831,58 @@ def create_pop_density_scatter(value):
     }
 
 # ** Trip map **
+# zooms of the generated hotspot map offered in srcSet (512 to 2048 px wide)
+tripmap_zooms = [1, 2, 3]
+
 def display_tripmap(value):
-    image_tripmap = 'img/' + value + '-tripmap.jpeg'
-    encoded_tripmap = base64.b64encode(open(image_tripmap, 'rb').read())
-    return 'data:image/jpeg;base64,{}'.format(encoded_tripmap.decode())
+    grid = data.current()['hotspots']
+    if grid is not None and value in grid['wards']:
+        # drawn from the period's trips (hotspots.py); PNG only
+        return hotspots.url(grid, value, tripmap_zooms[0]), \
+        hotspots.srcset(grid, value, tripmap_zooms), \
+        None
+    image_tripmap = value + '-tripmap.jpeg'
+    return images.url(image_tripmap), \
+    images.srcset(image_tripmap, 'image/jpeg'), \
+    images.srcset(image_tripmap, 'image/webp')
 
 # ** Growth bar chart **
 def create_growth_bars(value):
-    ward_val_2016 = df_growth.loc[df_growth['ward']==value,'Sept2016'].values[0]
-    ward_val_2018 = df_growth.loc[df_growth['ward']==value,'Sept2018'].values[0]
-
-    city_val_2016 = df_growth.loc[df_growth['ward']=='city','Sept2016'].values[0]
-    city_val_2018 = df_growth.loc[df_growth['ward']=='city','Sept2018'].values[0]
-
-    trace1 = go.Bar(
-            x=['2016*     2018*', '2016*     2018*      .'],
-            y=[ward_val_2016, city_val_2016],
-            text=[repr(round(ward_val_2016, -2)/1000)+'k', repr(round(city_val_2016, -2)/1000)+'k'],
+    profile = ward_profile(value)
+    ward_val_before = profile['growth_before']
+    ward_val_after = profile['growth_after']
+
+    city_val_before = city_profile()['growth_before']
+    city_val_after = city_profile()['growth_after']
+
+    # the period and the same month two years before
+    period = current_period()
+    base = periods.growth_base(period)
+    years = '{}*     {}*'.format(base[:4], period[:4])
+
+    trace1 = dict(
+            type='bar',
+            x=[years, years + '      .'],
+            y=[ward_val_before, city_val_before],
+            text=[repr(round(ward_val_before, -2)/1000)+'k', repr(round(city_val_before, -2)/1000)+'k'],
             textposition = 'auto',
             textfont= {
                 'size': 14,
                 # 'color': 'white'
             },
-            name='Sept 2016'
+            name=periods.short(base)
         )
-    trace2 = go.Bar(
-        x=['2016*     2018*', '2016*     2018*      .'],
-        y=[ward_val_2018, city_val_2018],
-        text=[repr(round(ward_val_2018, -2)/1000)+'k', repr(round(city_val_2018, -2)/1000)+'k'],
+    trace2 = dict(
+        type='bar',
+        x=[years, years + '      .'],
+        y=[ward_val_after, city_val_after],
+        text=[repr(round(ward_val_after, -2)/1000)+'k', repr(round(city_val_after, -2)/1000)+'k'],
         textposition = 'auto',
         textfont= {
             'size': 14,
             'color': 'white'
         },
-        name='Sept 2018'
+        name=periods.short(period)
     )
     return {
         'data': [trace1, trace2],
@@ -834,7 +900,7 @@ def create_growth_bars(value):
 
 # ** Day of Week time series **
 def create_dow_timeseries(value):
-    index = list(df_dow_ts.index)
+    index = list(frame('df_dow_ts').index)
     # x-axis tick labels
     # divide 24h into a time chunk of interest (6h)
     dt = 6
@@ -846,17 +912,19 @@ def create_dow_timeseries(value):
 
     return {
         'data': [
-            go.Scatter(
+            dict(
+                type='scatter',
                 x=index,
-                y=df_dow_ts['city'].values,
+                y=city_profile()['dow'],
                 mode='lines',
                 line={'color': city_ward_colours[1], 'width': 2},
                 name='City'
             ),
             # ward
-            go.Scatter(
+            dict(
+                type='scatter',
                 x=index,
-                y=df_dow_ts[value].values,
+                y=ward_profile(value)['dow'],
                 mode='lines',
                 line={'color': city_ward_colours[0], 'width': 4},
                 name=ward_dict[value]
@@ -891,79 +959,75 @@ def create_dow_timeseries(value):
 # ==============================================================================
 # ** Function to make the 2 top5 destination tables
 # (in `create_top5_table` and `create_busiest_top5_dest_table`)
-def make_table(this_ward,table_cols,df):
+def make_table(table_cols, rows):
     """
     Creates the top5 destination tables.
     Inputs:
-    this_ward: value from drop-down menu
-    table_cols: columns of table to be created
-    df: input df from EC2 used to create the output table
+    table_cols: columns of table to be created, or the header row (html.Tr)
+    rows: (destination, trips, fraction) rows from the ward profile store
 
     Outputs:
-    df_table
+    html.Table
     """
-    df_table = pd.DataFrame(columns=table_cols)
-
-    # Store values for first column of df_table in an array
-    # Note col0 is the ward
-    d1 = df.loc[df['ward']==this_ward, df.columns[1]].values[0]
-    d2 = df.loc[df['ward']==this_ward, df.columns[2]].values[0]
-    d3 = df.loc[df['ward']==this_ward, df.columns[3]].values[0]
-    d4 = df.loc[df['ward']==this_ward, df.columns[4]].values[0]
-    d5 = df.loc[df['ward']==this_ward, df.columns[5]].values[0]
-    d_arr = [d1, d2, d3, d4, d5]
-
-    # Store values for second column of df_table in an array
-    t1 = df.loc[df['ward']==this_ward, df.columns[6]].values[0]
-    t2 = df.loc[df['ward']==this_ward, df.columns[7]].values[0]
-    t3 = df.loc[df['ward']==this_ward, df.columns[8]].values[0]
-    t4 = df.loc[df['ward']==this_ward, df.columns[9]].values[0]
-    t5 = df.loc[df['ward']==this_ward, df.columns[10]].values[0]
-    t_arr = [t1, t2, t3, t4, t5]
-
-    # Store values for third column of df_table in an array
-    f1 = df.loc[df['ward']==this_ward, df.columns[11]].values[0]
-    f2 = df.loc[df['ward']==this_ward, df.columns[12]].values[0]
-    f3 = df.loc[df['ward']==this_ward, df.columns[13]].values[0]
-    f4 = df.loc[df['ward']==this_ward, df.columns[14]].values[0]
-    f5 = df.loc[df['ward']==this_ward, df.columns[15]].values[0]
-    f_arr = [f1, f2, f3, f4, f5]
-
-    # Assemble output table
-    df_table = pd.DataFrame(columns=table_cols)
-    df_table[table_cols[0]] = d_arr
-    df_table[table_cols[1]] = t_arr
-    df_table[table_cols[2]] = f_arr
-
-    return df_table
-# ==============================================================================
-
-# ** Top-5 destinations table **
-def create_top5_table(value):
-    # Create the table à la volée
-    table_cols = ['Destination', 'Trips/day', 'Fraction (%)']
-    df_dest_table = make_table(value,table_cols,df_top5_dest)
-
+    if not isinstance(table_cols, html.Tr):
+        table_cols = html.Tr([html.Th(col) for col in table_cols])
     return html.Table(
         # Header
-        [html.Tr([html.Th(col) for col in table_cols])] +
+        [table_cols] +
 
         # Body
-        [html.Tr([
-            html.Td(
-            df_dest_table.iloc[i][col]
-            ) for col in table_cols
-        ]) for i in range(len(df_dest_table))]
+        [html.Tr([html.Td(cell) for cell in row]) for row in rows]
     )
 
+# profile field -> table columns; '{}' is the number of destinations
+dest_table_cols = {
+    'top5_dest': ['Destination', 'Trips/day', 'Fraction (%)'],
+    'busiest_top5_dest': ['Top {} Destinations', 'Trips', '%'],
+}
+
+def make_dest_tables(dataset):
+    """
+    Creates the destination tables of every ward of a data set.
+    Outputs:
+    dict of profile field -> {ward id: html.Table}
+    """
+    tables = {}
+    for field, cols in dest_table_cols.items():
+        rows = {key: profile[field] for key, profile in dataset['wards'].items()
+                if field in profile}
+        n = max([len(r) for r in rows.values()] or [0])
+        header = html.Tr([html.Th(col.format(n)) for col in cols])
+        tables[field] = {key: make_table(header, r) for key, r in rows.items()}
+    return tables
+
+def dest_table(field, value):
+    """The pre-built destination table `field` of a ward."""
+    dataset = data.current()
+    if 'tables' not in dataset:
+        # every ward at once, the first time the data set is asked; requests
+        # racing here build the same tables
+        tables = make_dest_tables(dataset)
+        # their encoded size stands in for their memory in the period budget
+        dataset['tables_size'] = len(cache.encode(tables))
+        dataset['tables'] = tables
+    with metrics.stage('lookup'):
+        return dataset['tables'][field][store.ward_id(value)]
+# ==============================================================================
+
+# ** Top-5 destinations table **
+def create_top5_table(value):
+    return dest_table('top5_dest', value)
+
 # BUSIEST HOUR
 # ** Pie fraction **
 def create_pie_fraction(value):
-    pu = df_busiest_pudo_info.loc[df_busiest_pudo_info['ward']==value, 'Pickups'].values[0]
-    do = df_busiest_pudo_info.loc[df_busiest_pudo_info['ward']==value, 'Dropoffs'].values[0]
+    profile = ward_profile(value)
+    pu = profile['pickups']
+    do = profile['dropoffs']
     return {
         'data': [
-            go.Pie(
+            dict(
+                type='pie',
                 labels=['Pickups', 'Dropoffs'],
                 values=[pu, do],
                 hoverinfo='label+percent', textinfo='value',
@@ -985,111 +1049,167 @@ def create_pie_fraction(value):
 
 # ** Busiest hour info table **
 def create_busiest_top5_dest_table(value):
-    # Create the table à la volée
-    table2_cols = ['Top 5 Destinations', 'Trips', '%']
-    df_dest_table2 = make_table(value,table2_cols,df_busiest_top5_dest)
-
-    return html.Table(
-        # Header
-        [html.Tr([html.Th(col) for col in table2_cols])] +
-
-        # Body
-        [html.Tr([
-            html.Td(
-            df_dest_table2.iloc[i][col]
-            ) for col in table2_cols
-        ]) for i in range(len(df_dest_table2))]
-    )
+    return dest_table('busiest_top5_dest', value)
 
 # ------------------------------------------------------------------------------
 # Update charts after menu selection
 
-# ** map icon **
-@app.callback(
- dash.dependencies.Output('map-icon', 'src'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_display_map_icon(value):
-    return display_map_icon(value)
-
-# WARD PROFILE SECTION
-# ** avg trips/day **
-@app.callback(
- dash.dependencies.Output('daily-trips-rank', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_daily_rank_scatter(value):
-    return create_daily_rank_scatter(value)
-# ** ward pop **
-@app.callback(
- dash.dependencies.Output('stats-pop', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_ward_pop(value):
-    return create_pop_scatter(value)
-# ** ward pop density **
-@app.callback(
- dash.dependencies.Output('stats-pop-density', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_ward_pop_density(value):
-    return create_pop_density_scatter(value)
-# ** ward pop density **
-@app.callback(
- dash.dependencies.Output('stats-pop-growth', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_ward_pop_density(value):
-    return create_pop_density_scatter(value)
-
-# ** trip map **
-@app.callback(
- dash.dependencies.Output('map-trips', 'src'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_display_maps(value):
-    return display_tripmap(value)
-
-# ** top-5 destinations table **
-@app.callback(
- dash.dependencies.Output('top5-table', 'children'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_top5_table(value):
-    return create_top5_table(value)
-
-# ** growth ts **
-@app.callback(
- dash.dependencies.Output('growth-bars', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_growth_bars(value):
-    return create_growth_bars(value)
-
-# ** dow ts **
-@app.callback(
- dash.dependencies.Output('dow-timeseries', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_growth_timeseries(value):
-    return create_dow_timeseries(value)
-
-# ** pickups vs dropoffs fraction pie chart **
-@app.callback(
- dash.dependencies.Output('pie-fraction', 'figure'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_pie_fraction(value):
-    return create_pie_fraction(value)
-
-# ** busiest hour top5-destinations table **
-@app.callback(
- dash.dependencies.Output('top5-busiest-table', 'children'),
- [dash.dependencies.Input('ward-dropdown', 'value')]
- )
-def update_busiest_info_table(value):
-    return create_busiest_top5_dest_table(value)
-
+# Everything that depends on the selected ward, as
+# (outputs, function) pairs. Functions with several outputs return a tuple.
+ward_renderers = [
+    # ** text updates **
+    ([('ward-title', 'children'),
+      ('dailytrip-value', 'children'),
+      ('vkt-value', 'children'),
+      ('pop_val', 'children'),
+      ('popdensity-value', 'children')], update_stats),
+    ([('map-caption', 'children')], update_mapcaption),
+    ([('report-period', 'children'),
+      ('busiest-hour-title', 'children'),
+      ('dow-footnote', 'children')], update_period_texts),
+    ([('growth-pc-ward', 'children'),
+      ('growth-pc-city', 'children')], update_growth),
+    ([('top5-caption', 'children'),
+      ('busiest-title', 'children'),
+      ('total-trips', 'children'),
+      ('busiest-obs-caption', 'children')], update_busy_texts),
+    # ** map icon **
+    ([('map-icon', 'src'),
+      ('map-icon', 'srcSet'),
+      ('map-icon-webp', 'srcSet')], display_map_icon),
+    # WARD PROFILE SECTION
+    # ** avg trips/day **
+    ([('daily-trips-rank', 'figure')], create_daily_rank_scatter),
+    # ** ward pop **
+    ([('stats-pop', 'figure')], create_pop_scatter),
+    # ** ward pop density **
+    ([('stats-pop-density', 'figure')], create_pop_density_scatter),
+    ([('stats-pop-growth', 'figure')], create_pop_density_scatter),
+    # ** trip map **
+    ([('map-trips', 'src'),
+      ('map-trips', 'srcSet'),
+      ('map-trips-webp', 'srcSet')], display_tripmap),
+    # ** top-5 destinations table **
+    ([('top5-table', 'children')], create_top5_table),
+    # ** growth ts **
+    ([('growth-bars', 'figure')], create_growth_bars),
+    # ** dow ts **
+    ([('dow-timeseries', 'figure')], create_dow_timeseries),
+    # ** pickups vs dropoffs fraction pie chart **
+    ([('pie-fraction', 'figure')], create_pie_fraction),
+    # ** busiest hour top5-destinations table **
+    ([('top5-busiest-table', 'children')], create_busiest_top5_dest_table),
+]
+
+def render_ward(value, period=None):
+    """
+    Runs every ward renderer for one drop-down value, against the data of
+    `period` (default: the data set this request is pinned to).
+    Returns the output values flattened in `ward_renderers` order.
+    """
+    values = []
+    with data.pinned(data.dataset(period)):
+        for outputs, func in ward_renderers:
+            result = func(value)
+            if len(outputs) > 1:
+                values.extend(result)
+            else:
+                values.append(result)
+    return values
+
+def for_period(func):
+    """Callback running func(value) against the selected period's data."""
+    def callback(value, period):
+        with data.pinned(data.dataset(period)):
+            return func(value)
+    callback.__name__ = func.__name__
+    return callback
+
+def _outputs(outputs):
+    if len(outputs) > 1:
+        return [dash.dependencies.Output(i, p) for i, p in outputs]
+    return dash.dependencies.Output(*outputs[0])
+
+# WP_CALLBACK_MODE=single (default) updates the whole page with one request per
+# ward change; WP_CALLBACK_MODE=granular keeps one callback per section.
+callback_mode = os.environ.get('WP_CALLBACK_MODE', 'single')
+ward_input = [dash.dependencies.Input('ward-dropdown', 'value'),
+              dash.dependencies.Input('period-dropdown', 'value')]
+
+if callback_mode == 'granular':
+    for outputs, func in ward_renderers:
+        app.callback(_outputs(outputs), ward_input)(for_period(func))
+else:
+    app.callback(
+        _outputs([output for outputs, _ in ward_renderers for output in outputs]),
+        ward_input
+    )(render_ward)
+
+# Figures, and whole callback responses, are built and JSON-encoded once per
+# ward and data version, and the bytes are served directly (with an ETag).
+# WP_FIGURE_CACHE=lazy (default) fills the cache on first use, eager builds
+# every ward's figures at startup, off disables both.
+# The ward callbacks are answered by cache.WardResponses either way, which also
+# times their build and encode stages.
+figure_cache = os.environ.get('WP_FIGURE_CACHE', 'lazy')
+cached_figures = [create_daily_rank_scatter, create_pop_scatter,
+                  create_pop_density_scatter, create_growth_bars,
+                  create_dow_timeseries, create_pie_fraction]
+
+ward_responses = cache.WardResponses(ward_renderers,
+                                     lambda: data.current()['version'],
+                                     cached_figures if figure_cache != 'off' else [])
+cache.register(app, ward_responses, 'ward-dropdown', ward_dict,
+               cache_responses=figure_cache != 'off',
+               select=lambda inputs: data.dataset(inputs.get('period-dropdown')))
+# cache entries live as long as their data set (swapped out or evicted period)
+data.add_listener(lambda: cache.retain(data.versions()))
+data.add_listener(lambda: hotspots.retain(
+    [dataset['hotspots'] for dataset in data.loaded() if dataset['hotspots']]))
+data.add_sizer(lambda dataset: cache.size(dataset['version']) +
+               dataset.get('tables_size', 0))
+cache.retain(data.versions())
+# the layout and callback list, serialized once (every callback is registered)
+cache.register_page(app)
+if figure_cache == 'eager':
+    ward_responses.warm(ward_dict)
+
+# ** warm-up **
+# Every ward is rendered once before the process takes traffic; /ready reports
+# 503 until then. WP_WARMUP=0 skips it.
+def warm_up():
+    targets = ['{}.{}'.format(*output)
+               for outputs, _ in ward_renderers for output in outputs]
+    for ward in ward_dict:
+        ward_responses.response(targets, ward)
+
+# ** data refresh **
+def on_data_swap(dataset):
+    metrics.gauge('wp_data_version_info', (('version', dataset['version']),), 1)
+    if figure_cache == 'eager':
+        with data.pinned(dataset):
+            ward_responses.warm(ward_dict)
+
+def start_background():
+    """
+    Starts the threads each serving process needs: the data refresher, when
+    WP_REFRESH_INTERVAL and/or WP_REFRESH_CHANNEL (Postgres LISTEN/NOTIFY) is set,
+    and the warm-up unless it already ran.
+    """
+    data.start_refresher(on_swap=on_data_swap)
+    if not warmup.ready():
+        warmup.start(warm_up)
+
+if os.environ.get('WP_WARMUP', '1') == '0':
+    warmup.skip()
+elif os.environ.get('WP_PRELOAD') == '1':
+    # in the gunicorn master, so the workers fork warm and ready
+    warmup.run(warm_up)
+
+# Threads don't survive a fork, so when gunicorn preloads the app in its master
+# (gunicorn.conf.py) they are started in each worker after forking instead.
+if os.environ.get('WP_PRELOAD') != '1':
+    start_background()
 
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,149 @@
+"""
+Callback latency benchmark.
+
+    python bench.py [--rounds N] [--save FILE] [--compare FILE]
+
+Loads the wp_* tables from the CSV fixtures in fixtures/ (unless WP_FIXTURES
+is already set), drives every ward through each callback listed by
+_dash-dependencies using the Flask test client, and reports p50/p95/p99
+latency and response bytes per callback, plus the total for one ward switch.
+Results can be saved as a baseline and compared against on a later run.
+The WP_* settings (WP_CALLBACK_MODE, WP_FIGURE_CACHE, ...) apply as usual.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault('WP_FIXTURES', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+# measure from cold, without a warm-up thread racing the first round
+os.environ.setdefault('WP_WARMUP', '0')
+
+import app
+
+SWITCH = '(ward switch)'
+SETTINGS = ['WP_CALLBACK_MODE', 'WP_FIGURE_CACHE', 'WP_FIXTURES', 'WP_WARMUP']
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted list."""
+    index = max(0, min(len(values) - 1, int(round(q / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def summarise(times, sizes):
+    times = sorted(times)
+    return {
+        'n': len(times),
+        'p50_ms': percentile(times, 50) * 1e3,
+        'p95_ms': percentile(times, 95) * 1e3,
+        'p99_ms': percentile(times, 99) * 1e3,
+        'bytes': int(sum(sizes) / len(sizes)),
+    }
+
+
+def run(rounds):
+    """
+    Runs every ward through every ward-dropdown callback `rounds` times.
+    Outputs:
+    dict of callback output -> summary
+    """
+    client = app.server.test_client()
+    prefix = app.app.config.routes_pathname_prefix
+    dependencies = json.loads(client.get(prefix + '_dash-dependencies').data)
+    dependencies = [dep for dep in dependencies
+                    if any(i['id'] == 'ward-dropdown' for i in dep['inputs'])]
+
+    times = {dep['output']: [] for dep in dependencies}
+    sizes = {dep['output']: [] for dep in dependencies}
+    switch_times, switch_sizes = [], []
+    for _ in range(rounds):
+        for ward in app.ward_dict:
+            switch_time = switch_size = 0
+            for dep in dependencies:
+                body = {'output': dep['output'],
+                        'inputs': [{'id': 'ward-dropdown', 'property': 'value',
+                                    'value': ward}]}
+                start = time.perf_counter()
+                response = client.post(prefix + '_dash-update-component',
+                                       json=body)
+                elapsed = time.perf_counter() - start
+                if response.status_code != 200:
+                    raise RuntimeError('{} for {} returned {}'.format(
+                        dep['output'], ward, response.status_code))
+                times[dep['output']].append(elapsed)
+                sizes[dep['output']].append(len(response.data))
+                switch_time += elapsed
+                switch_size += len(response.data)
+            switch_times.append(switch_time)
+            switch_sizes.append(switch_size)
+
+    results = {output: summarise(times[output], sizes[output])
+               for output in times}
+    results[SWITCH] = summarise(switch_times, switch_sizes)
+    results[SWITCH]['requests'] = len(dependencies)
+    return results
+
+
+def report(results, baseline=None):
+    header = '{:<60} {:>9} {:>9} {:>9} {:>10}'.format(
+        'callback', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes')
+    print(header)
+    print('-' * len(header))
+    for output in sorted(results, key=lambda o: (o == SWITCH, o)):
+        r = results[output]
+        name = output if len(output) <= 60 else output[:57] + '...'
+        print('{:<60} {:>9.2f} {:>9.2f} {:>9.2f} {:>10}'.format(
+            name, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['bytes']))
+        if baseline and output in baseline:
+            b = baseline[output]
+            print('{:<60} {:>+8.0f}% {:>+8.0f}% {:>+8.0f}% {:>+9.0f}%'.format(
+                '  vs baseline',
+                *[100.0 * (r[k] - b[k]) / b[k] if b[k] else 0
+                  for k in ('p50_ms', 'p95_ms', 'p99_ms', 'bytes')]))
+
+
+def regressions(results, baseline, threshold):
+    """Callbacks whose p95 grew by more than threshold percent."""
+    return [output for output, r in results.items()
+            if output in baseline and baseline[output]['p95_ms'] and
+            r['p95_ms'] > baseline[output]['p95_ms'] * (1 + threshold / 100.0)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='passes over the 25 wards (default 5)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='p95 regression (%%) that fails --compare')
+    args = parser.parse_args()
+
+    results = run(args.rounds)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'rounds': args.rounds,
+                       'settings': {k: os.environ.get(k) for k in SETTINGS},
+                       'results': results}, f, indent=1, sort_keys=True)
+
+    if baseline:
+        regressed = regressions(results, baseline, args.threshold)
+        if regressed:
+            print('\np95 regressed by more than {:.0f}%: {}'.format(
+                args.threshold, ', '.join(regressed)))
+            sys.exit(1)
@@ -0,0 +1,109 @@
+"""
+Builds resized variants of the trip maps and inset icons.
+
+    python build_images.py [--force]
+
+For every img/*-tripmap.jpeg and img/inset/*.png this writes WebP and
+progressive JPEG (or optimised PNG, for the insets) copies at several widths
+to img/variants/, plus img/variants/manifest.json, which images.py reads to
+build the `srcSet` lists the callbacks send. A source whose content and
+settings haven't changed since the last build is skipped.
+Requires Pillow, which the app itself doesn't need.
+"""
+import argparse
+import json
+import logging
+import os
+
+from PIL import Image
+
+import images
+
+LOGGER = logging.getLogger(__name__)
+
+VARIANTS_DIR = os.path.join(images.IMG_DIR, 'variants')
+MANIFEST = os.path.join(VARIANTS_DIR, 'manifest.json')
+
+# which sources get built, at which widths and in which formats
+RULES = [
+    {'match': lambda rel: rel.endswith('-tripmap.jpeg'),
+     'widths': [480, 800, 1200, 1600, 2400],
+     'formats': [('webp', 'image/webp', {'quality': 80, 'method': 6}),
+                 ('jpeg', 'image/jpeg', {'quality': 82, 'progressive': True,
+                                         'optimize': True})]},
+    {'match': lambda rel: rel.startswith('inset/') and rel.endswith('.png'),
+     'widths': [160, 320, 480],
+     'formats': [('webp', 'image/webp', {'quality': 85, 'method': 6}),
+                 ('png', 'image/png', {'optimize': True})]},
+]
+
+
+def _settings(rule):
+    return {'widths': rule['widths'],
+            'formats': [[ext, options] for ext, _, options in rule['formats']]}
+
+
+def build_variants(rel, rule):
+    """
+    Writes the variants of the source image at img/<rel>.
+    Outputs:
+    list of {'path', 'width', 'type'} with paths relative to img/
+    """
+    base = os.path.splitext(rel)[0]
+    variants = []
+    with Image.open(os.path.join(images.IMG_DIR, rel)) as source:
+        source.load()
+        for width in sorted(set(w for w in rule['widths'] if w < source.width)):
+            height = int(round(source.height * width / float(source.width)))
+            resized = source.resize((width, height), Image.LANCZOS)
+            for ext, mimetype, options in rule['formats']:
+                image = resized
+                if ext == 'jpeg' and image.mode != 'RGB':
+                    image = image.convert('RGB')
+                path = 'variants/{}-{}.{}'.format(base, width, ext)
+                dest = os.path.join(images.IMG_DIR, path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                image.save(dest, ext.upper(), **options)
+                variants.append({'path': path, 'width': width, 'type': mimetype})
+    return variants
+
+
+def build(force=False):
+    """Builds the variants of every source image that changed."""
+    try:
+        with open(MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    index = images.build_index()
+    built = 0
+    for rel in sorted(index):
+        rule = next((r for r in RULES if r['match'](rel)), None)
+        if rule is None or rel.startswith('variants/'):
+            continue
+        digest = index[rel]
+        entry = manifest.get(rel)
+        if (not force and entry is not None and entry['source'] == digest and
+                entry['settings'] == _settings(rule) and
+                all(os.path.exists(os.path.join(images.IMG_DIR, v['path']))
+                    for v in entry['variants'])):
+            continue
+        manifest[rel] = {'source': digest, 'settings': _settings(rule),
+                         'variants': build_variants(rel, rule)}
+        LOGGER.info('Built %d variants of %s', len(manifest[rel]['variants']), rel)
+        built += 1
+
+    os.makedirs(VARIANTS_DIR, exist_ok=True)
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    LOGGER.info('%d of %d images rebuilt', built, len(manifest))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild every image')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    build(args.force)
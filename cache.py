@@ -0,0 +1,304 @@
+"""
+Pre-serialized response cache for the ward callbacks.
+
+The outputs of the cached renderers are encoded to JSON once per
+(data version, renderer, ward) and kept as bytes. A before_request hook on
+_dash-update-component answers ward callbacks by splicing those bytes into
+the response Dash would have produced, so cached figures are neither rebuilt
+nor re-encoded. Entries are kept per data version (one per report period) and
+dropped by `retain` once their data set is swapped out or evicted. Uncached
+renderers go through the same path, which is where the callback stages
+(build, encode) are timed for metrics.py.
+
+Whole callback responses are kept as well, keyed by (callback output, ward)
+and data version, with an ETag derived from the three, so a repeated ward
+switch is answered from memory, or with a 304 when the client sends
+If-None-Match.
+
+`register_page` serves _dash-layout and _dash-dependencies, which don't change
+while the process runs, from bytes serialized once, with an ETag so browsers
+revalidate them with a 304.
+"""
+import hashlib
+import json
+import threading
+import time
+
+import flask
+import plotly
+
+import data
+import metrics
+
+_lock = threading.Lock()
+_live = set()  # data versions whose entries are kept
+_parts = {}  # (data version, renderer index, ward) -> [encoded output, ...]
+_responses = {}  # (data version, callback output, ward) -> (body, etag)
+
+
+def encode(value):
+    """JSON bytes of a callback output, encoded the way Dash does it."""
+    return json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder).encode()
+
+
+def retain(versions):
+    """Keeps the entries of the data `versions` only, dropping the rest."""
+    global _live
+    with _lock:
+        _live = set(versions)
+        for entries in (_parts, _responses):
+            for entry in [k for k in entries if k[0] not in _live]:
+                del entries[entry]
+
+
+def size(version):
+    """Bytes of the entries kept for a data version."""
+    with _lock:
+        return (sum(len(part) for k, parts in _parts.items() if k[0] == version
+                    for part in parts) +
+                sum(len(body) for k, (body, _) in _responses.items()
+                    if k[0] == version))
+
+
+def get(version, key, ward, build):
+    """
+    Encoded outputs of renderer `key` for `ward`, calling build() on a miss.
+    build returns the list of encoded outputs. `ward` must be a valid ward, as
+    checked by `register`, or the cache grows with every value sent.
+    """
+    try:
+        parts = _parts[(version, key, ward)]
+        metrics.inc('wp_figure_cache_hits_total')
+        return parts
+    except KeyError:
+        pass
+    metrics.inc('wp_figure_cache_misses_total')
+    parts = build()
+    with _lock:
+        if version in _live:
+            _parts[(version, key, ward)] = parts
+    return parts
+
+
+def etag(version, output, ward):
+    """ETag of a callback response; it only changes with the data version."""
+    key = '\0'.join([version, output, str(ward)])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def cached_response(version, output, ward, build):
+    """
+    (body, etag) of the callback `output` for `ward`, calling build() for the
+    body on a miss. `ward` must be a valid ward, as for `get`.
+    """
+    try:
+        entry = _responses[(version, output, ward)]
+        metrics.inc('wp_response_cache_hits_total')
+        return entry
+    except KeyError:
+        pass
+    metrics.inc('wp_response_cache_misses_total')
+    entry = (build(), etag(version, output, ward))
+    with _lock:
+        if version in _live:
+            _responses[(version, output, ward)] = entry
+    return entry
+
+
+def _targets(output):
+    """'id.prop' or '..id1.prop1...id2.prop2..' -> ['id.prop', ...]"""
+    if output.startswith('..') and output.endswith('..'):
+        return output[2:-2].split('...')
+    return [output]
+
+
+def callback_label(output):
+    """Label of the callback `output` ('id.prop' or the multi-output form)."""
+    return _label(_targets(output))
+
+
+def _values(outputs, result):
+    return list(result) if len(outputs) > 1 else [result]
+
+
+def _label(targets):
+    """Metrics label of a callback: its first output, plus how many more."""
+    if len(targets) == 1:
+        return targets[0]
+    return '{}+{}'.format(targets[0], len(targets) - 1)
+
+
+class WardResponses(object):
+    """
+    Builds _dash-update-component responses for the ward renderers.
+    Inputs:
+    renderers: [(outputs, func)] pairs, as `app.ward_renderers`
+    get_version: callable returning the current data version
+    cached: renderer functions whose outputs are kept in the cache
+    """
+
+    def __init__(self, renderers, get_version, cached):
+        self.renderers = renderers
+        self.get_version = get_version
+        self.cached = set(cached)
+        self.by_target = {}
+        for key, (outputs, func) in enumerate(renderers):
+            for i, (component_id, prop) in enumerate(outputs):
+                self.by_target['{}.{}'.format(component_id, prop)] = (key, i)
+
+    def handles(self, targets):
+        return all(target in self.by_target for target in targets)
+
+    def parts(self, key, ward):
+        """Encoded outputs of renderer `key` for `ward`."""
+        outputs, func = self.renderers[key]
+
+        def build():
+            with metrics.stage('build'):
+                values = _values(outputs, func(ward))
+            with metrics.stage('encode'):
+                return [encode(value) for value in values]
+
+        if func in self.cached:
+            return get(self.get_version(), key, ward, build)
+        return build()
+
+    def warm(self, wards):
+        """Fills the cache for every cached renderer and ward."""
+        for key, (_, func) in enumerate(self.renderers):
+            if func in self.cached:
+                for ward in wards:
+                    self.parts(key, ward)
+
+    def response(self, targets, ward):
+        """The JSON body Dash would send for the callback `targets`."""
+        computed = {}
+        encoded = []
+        for target in targets:
+            key, i = self.by_target[target]
+            if key not in computed:
+                computed[key] = self.parts(key, ward)
+            encoded.append(computed[key][i])
+
+        if len(targets) == 1:
+            prop = targets[0].rsplit('.', 1)[1]
+            return b''.join([b'{"response": {"props": {',
+                             json.dumps(prop).encode(), b': ',
+                             encoded[0], b'}}}'])
+
+        # group by component, as Dash does for multi-output callbacks
+        components = []
+        for target, part in zip(targets, encoded):
+            component_id, prop = target.rsplit('.', 1)
+            if components and components[-1][0] == component_id:
+                components[-1][1].append((prop, part))
+            else:
+                components.append((component_id, [(prop, part)]))
+        body = b', '.join(
+            json.dumps(component_id).encode() + b': {' +
+            b', '.join(json.dumps(prop).encode() + b': ' + part
+                       for prop, part in props) + b'}'
+            for component_id, props in components)
+        return b'{"response": {' + body + b'}, "multi": true}'
+
+
+def register(app, responses, input_id, wards, cache_responses=True,
+             select=None):
+    """
+    Serves the ward callbacks handled by `responses` (a WardResponses) ahead
+    of Dash's own _dash-update-component view.
+    input_id: id of the component whose value is the ward
+    wards: the valid wards; a request for any other value gets a 400, before
+    anything is built or cached
+    cache_responses: keep whole responses, see `cached_response`
+    select: select({input id: value}) returns the data set to answer from
+    (e.g. that of the selected period); default the request's own
+    """
+    path = app.config.routes_pathname_prefix + '_dash-update-component'
+    wards_valid = frozenset(wards)
+
+    @app.server.before_request
+    def serve_ward_response():
+        if flask.request.method != 'POST' or flask.request.path != path:
+            return None
+        body = flask.request.get_json(silent=True) or {}
+        targets = _targets(body.get('output', ''))
+        if not responses.handles(targets):
+            return None
+        inputs = body.get('inputs', [])
+        wards = [i.get('value') for i in inputs if i.get('id') == input_id]
+        if len(wards) != 1 or wards[0] is None:
+            return None
+        # 'w01', 7 or '7' would each get cache entries of their own
+        if not isinstance(wards[0], str) or wards[0] not in wards_valid:
+            return flask.Response('Unknown ward', status=400,
+                                  mimetype='text/plain')
+
+        start = time.perf_counter()
+        metrics.begin()
+        dataset = data.current()
+        if select is not None:
+            dataset = select({i.get('id'): i.get('value') for i in inputs})
+        with data.pinned(dataset):
+            version = responses.get_version()
+            output = body['output']
+            if cache_responses:
+                content, tag = cached_response(
+                    version, output, wards[0],
+                    lambda: responses.response(targets, wards[0]))
+            else:
+                content = responses.response(targets, wards[0])
+                tag = etag(version, output, wards[0])
+        response = conditional(content, tag)
+        if response.status_code == 304:
+            metrics.inc('wp_callback_not_modified_total')
+        metrics.end(_label(targets), wards[0], len(response.get_data()),
+                    time.perf_counter() - start)
+        return response
+
+    return serve_ward_response
+
+
+def conditional(content, etag, mimetype='application/json', cache_control=None):
+    """
+    Response with `content` and a strong ETag, or a 304 when the request's
+    If-None-Match has the tag. The match is weak, as compress.py turns the
+    ETag of a compressed body into a weak one.
+    """
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(content, mimetype=mimetype)
+    response.set_etag(etag)
+    if cache_control is not None:
+        response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def register_page(app):
+    """
+    Serves _dash-layout and _dash-dependencies from pre-serialized bytes.
+    Call it after every callback is registered. A layout function (rather than
+    a static tree) is left to Dash.
+    """
+    prefix = app.config.routes_pathname_prefix
+    views = {prefix + '_dash-dependencies': app.dependencies}
+    if not callable(app.layout):
+        views[prefix + '_dash-layout'] = app.serve_layout
+
+    # Dash's own views, run once, so the bytes are exactly what they'd send
+    pages = {}
+    with app.server.test_request_context():
+        for path, view in views.items():
+            content = view().get_data()
+            pages[path] = (content, hashlib.sha1(content).hexdigest()[:16])
+
+    @app.server.before_request
+    def serve_page():
+        if flask.request.method != 'GET' or flask.request.path not in pages:
+            return None
+        content, etag = pages[flask.request.path]
+        # revalidated on every page load, so a deploy is picked up at once
+        return conditional(content, etag, cache_control='no-cache')
+
+    return serve_page
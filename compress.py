@@ -0,0 +1,118 @@
+"""
+Response compression for the Flask server.
+
+Responses above a size threshold whose content type is in the allowlist are
+compressed with brotli (when the module is installed and the client accepts
+it) or gzip. Static files (Dash component suites, assets/) don't change, so
+their compressed bodies are kept in memory, keyed by path and a hash of the
+body, and compressed once at the highest level.
+
+    WP_COMPRESS=0               disables compression
+    WP_COMPRESS_MIN_SIZE=500    smallest body, in bytes, worth compressing
+"""
+import collections
+import gzip
+import hashlib
+import io
+import os
+import threading
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CONTENT_TYPES = (
+    'application/json',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/javascript',
+    'text/plain',
+    'image/svg+xml',
+    'image/x-icon',
+)
+
+# (encoding, static) -> level; dynamic bodies trade ratio for speed
+LEVELS = {('gzip', False): 6, ('gzip', True): 9,
+          ('br', False): 4, ('br', True): 11}
+
+# compressed static bodies kept, at most; the oldest are dropped beyond it
+STATIC_ENTRIES = 128
+
+_lock = threading.Lock()
+_static = collections.OrderedDict()  # (path, encoding, body hash) -> bytes
+
+
+def _encoding():
+    """Best encoding the client accepts, or None."""
+    accepted = flask.request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(content, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(content, quality=level)
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def register(server, static_prefixes=(), min_size=None):
+    """
+    Compresses the server's responses.
+    static_prefixes: URL prefixes whose compressed bodies can be kept
+    """
+    if min_size is None:
+        min_size = int(os.environ.get('WP_COMPRESS_MIN_SIZE', 500))
+    static_prefixes = tuple(static_prefixes)
+
+    @server.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or
+                'Content-Encoding' in response.headers or
+                # Dash serves its scripts as application/JavaScript
+                response.mimetype.lower() not in CONTENT_TYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = _encoding()
+        if encoding is None:
+            return response
+
+        # send_file streams the file; read it so it can be compressed
+        response.direct_passthrough = False
+        content = response.get_data()
+        if len(content) < min_size:
+            return response
+
+        etag, weak = response.get_etag()
+        if flask.request.path.startswith(static_prefixes):
+            # keyed on the body, as the component suites are sent without an
+            # ETag, and not on the query string, which any client can vary
+            key = (flask.request.path, encoding,
+                   hashlib.sha1(content).hexdigest())
+            compressed = _static.get(key)
+            if compressed is None:
+                compressed = compress(content, encoding, LEVELS[(encoding, True)])
+                with _lock:
+                    _static[key] = compressed
+                    while len(_static) > STATIC_ENTRIES:
+                        _static.popitem(last=False)
+        else:
+            compressed = compress(content, encoding, LEVELS[(encoding, False)])
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None and not weak:
+            # the compressed body is a different representation
+            response.set_etag(etag, weak=True)
+        return response
+
+    return compress_response
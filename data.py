@@ -0,0 +1,484 @@
+"""
+Data loading for the ward profiles.
+
+Fetches the cnangini.wp_* tables concurrently through a small psycopg2
+connection pool, selecting only the columns declared in schema.py and casting
+them to its dtypes. The connections are closed as soon as the frames are loaded,
+so a worker doesn't hold a database connection for its whole life.
+`load_frames` puts the local snapshot (snapshot.py) in front of the database,
+or reads CSV fixtures instead of either when WP_FIXTURES is set.
+
+The loaded data set (frames, ward profiles and version) is held in a single
+reference that `swap` replaces atomically, so a background refresher can load
+new data off the request path. `current` returns the data set a request was
+pinned to, so one request never mixes two versions.
+
+That data set is the default report period's (periods.py). Other periods are
+loaded by `dataset` on first use and kept in a least recently used cache
+bounded by WP_PERIOD_CACHE_MB (estimated memory of the frames and of the
+responses and tables cached for them, default 256); the oldest are evicted
+beyond that.
+"""
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pandas.io.sql as pandasql
+from psycopg2 import connect
+from psycopg2.pool import ThreadedConnectionPool
+
+import hotspots
+import periods
+import schema
+import snapshot
+import store
+
+LOGGER = logging.getLogger(__name__)
+
+# frame name -> source table
+TABLES = collections.OrderedDict(
+    (name, spec['table']) for name, spec in schema.SCHEMA.items())
+
+
+def connection_params():
+    """
+    Connection arguments for psycopg2: DATABASE_URL when set (Heroku),
+    otherwise the [DBSETTINGS] section of config.cfg.
+    Returns (args, kwargs).
+    """
+    database_url = os.getenv("DATABASE_URL")
+    if database_url is not None:
+        return (database_url,), {}
+
+    import configparser
+    config = configparser.ConfigParser()
+    config.read('config.cfg')
+    return (), dict(config['DBSETTINGS'])
+
+
+def _fetch(pool, name, table):
+    con = pool.getconn()
+    try:
+        start = time.time()
+        df = schema.apply(name, pandasql.read_sql(schema.query(name, table), con))
+        LOGGER.info('Loaded %s: %d rows in %.3fs', table, len(df),
+                    time.time() - start)
+        return df
+    finally:
+        pool.putconn(con)
+
+
+def load_tables(pool_size=None, period=periods.ORIGINAL):
+    """
+    Fetches every table in TABLES concurrently.
+    Inputs:
+    pool_size: maximum number of connections, defaults to WP_DB_POOL_SIZE or 4
+    period: report period whose tables are read
+
+    Outputs:
+    dict of frame name -> DataFrame
+    """
+    if pool_size is None:
+        pool_size = int(os.environ.get('WP_DB_POOL_SIZE', 4))
+    pool_size = max(1, min(pool_size, len(TABLES)))
+
+    start = time.time()
+    args, kwargs = connection_params()
+    pool = ThreadedConnectionPool(1, pool_size, *args, **kwargs)
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = collections.OrderedDict(
+                (name, executor.submit(_fetch, pool, name,
+                                       periods.table(table, period)))
+                for name, table in TABLES.items()
+            )
+            frames = collections.OrderedDict(
+                (name, future.result()) for name, future in futures.items()
+            )
+    finally:
+        pool.closeall()
+
+    LOGGER.info('Loaded %d tables over %d connections in %.3fs',
+                len(frames), pool_size, time.time() - start)
+    return frames
+
+
+def load_fixtures(directory, period=periods.ORIGINAL):
+    """
+    Reads the tables from <directory>/<table>.csv, e.g. fixtures/wp_vkt.csv
+    (fixtures/201903/wp_vkt.csv for a later period), as a stand-in for the
+    database.
+    Outputs:
+    dict of frame name -> DataFrame
+    """
+    directory = os.path.join(directory, periods.suffix(period))
+    frames = collections.OrderedDict()
+    for name, table in TABLES.items():
+        path = os.path.join(directory, table.split('.')[-1] + '.csv')
+        frames[name] = schema.apply(name, pd.read_csv(path))
+    LOGGER.info('Loaded %d tables from fixtures in %s', len(frames), directory)
+    return frames
+
+
+def snapshot_dir(period):
+    """Snapshot directory of a period: <WP_SNAPSHOT_DIR>/<period>."""
+    return os.path.join(snapshot.snapshot_dir(), period)
+
+
+def read_snapshot(manifest, period=periods.ORIGINAL):
+    """The snapshot's frames, cast back to the schema's dtypes."""
+    return collections.OrderedDict(
+        (name, schema.apply(name, df))
+        for name, df in snapshot.read(manifest, snapshot_dir(period)).items())
+
+
+def data_version(frames, period=periods.ORIGINAL):
+    """
+    Content hash of a period's frames, used to version snapshots and caches.
+    """
+    digest = hashlib.sha1(period.encode())
+    for name in sorted(frames):
+        df = frames[name]
+        digest.update(name.encode())
+        digest.update(repr(list(df.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def load_frames(period=None):
+    """
+    Loads a period's frames (default: the default period) from the local
+    snapshot when it is fresh, otherwise from the database, refreshing the
+    snapshot. A stale snapshot is still used when the database can't be
+    reached.
+    Set WP_SNAPSHOT=0 to always go to the database, and WP_SNAPSHOT_MAX_AGE
+    (seconds, default 86400, 0 for never) to control staleness. With
+    WP_FIXTURES=<dir> the CSV fixtures are used and neither is touched.
+
+    Outputs:
+    (dict of frame name -> DataFrame, data version)
+    """
+    period = period or periods.default()
+    if (os.environ.get('WP_FIXTURES') or
+            os.environ.get('WP_SNAPSHOT', '1') == '0'):
+        return reload(period)
+
+    max_age = float(os.environ.get('WP_SNAPSHOT_MAX_AGE', 86400)) or None
+    manifest = snapshot.read_manifest(snapshot_dir(period))
+    if manifest is not None and snapshot.is_fresh(manifest, TABLES, max_age):
+        LOGGER.info('Loading snapshot %s of %s', manifest['version'], period)
+        return read_snapshot(manifest, period), manifest['version']
+
+    try:
+        return reload(period)
+    except Exception:
+        if manifest is None or set(manifest['tables']) != set(TABLES):
+            raise
+        LOGGER.exception('Database unavailable, falling back to stale '
+                         'snapshot %s of %s', manifest['version'], period)
+        return read_snapshot(manifest, period), manifest['version']
+
+
+def reload(period=None):
+    """
+    Queries the database for a period (default: the default period) and
+    refreshes its snapshot (unless WP_SNAPSHOT=0). With WP_FIXTURES=<dir> the
+    CSV fixtures are read again instead, and the snapshot isn't touched.
+    Outputs:
+    (dict of frame name -> DataFrame, data version)
+    """
+    period = period or periods.default()
+    fixtures = os.environ.get('WP_FIXTURES')
+    if fixtures:
+        frames = load_fixtures(fixtures, period)
+        return frames, data_version(frames, period)
+    frames = load_tables(period=period)
+    version = data_version(frames, period)
+    if os.environ.get('WP_SNAPSHOT', '1') != '0':
+        try:
+            snapshot.write(frames, version, snapshot_dir(period))
+        except OSError:
+            LOGGER.exception('Could not write snapshot')
+    return frames, version
+
+
+# -----------------------------------------------------------------------
+# Current data set
+
+_current = None
+_pinned = threading.local()
+
+_periods = collections.OrderedDict()  # period -> data set, least recent first
+_periods_lock = threading.Lock()
+_loading = {}  # period -> lock held while it loads
+_listeners = []
+_sizers = []
+
+
+def build_dataset(frames, version, period=None):
+    """
+    Bundles the frames with their ward profile store and hotspot map grid.
+    Outputs:
+    dict with 'period', 'version', 'frames', 'wards', 'city', 'lines' and
+    'hotspots' (None when the period has no grid); app.py adds 'tables', its
+    destination tables, and 'tables_size' on first use
+    """
+    period = period or periods.default()
+    profiles = store.build_profiles(**frames)
+    return {'period': period, 'version': version,
+            'frames': frames, 'wards': profiles['wards'],
+            'city': profiles['city'], 'lines': profiles['lines'],
+            'hotspots': hotspots.load(period)}
+
+
+def add_listener(func):
+    """func() is called whenever a data set is swapped in, loaded or evicted."""
+    _listeners.append(func)
+
+
+def add_sizer(func):
+    """
+    func(dataset) is the memory, in bytes, held for a data set outside its
+    frames (cached responses, built tables); it counts towards
+    WP_PERIOD_CACHE_MB.
+    """
+    _sizers.append(func)
+
+
+def _changed():
+    for func in _listeners:
+        func()
+
+
+def swap(dataset):
+    """Makes `dataset` the current data set."""
+    global _current
+    _current = dataset
+    _changed()
+
+
+def current():
+    """The data set pinned to this thread, or else the current one."""
+    return getattr(_pinned, 'dataset', None) or _current
+
+
+def pin():
+    """Pins this thread (request) to the current data set until `unpin`."""
+    _pinned.dataset = _current
+
+
+def unpin(*args):
+    _pinned.dataset = None
+
+
+def loaded():
+    """Every data set held: the current one, then the other periods'."""
+    with _periods_lock:
+        others = list(_periods.values())
+    return ([_current] if _current is not None else []) + others
+
+
+def versions():
+    return [dataset['version'] for dataset in loaded()]
+
+
+def dataset_size(dataset):
+    """Estimated memory of a data set, its frames and what the sizers count."""
+    return (sum(int(df.memory_usage(deep=True).sum())
+                for df in dataset['frames'].values()) +
+            sum(func(dataset) for func in _sizers))
+
+
+def _evict(budget):
+    """
+    Drops the least recently used periods until the rest fit in `budget`
+    bytes; the most recently used one is always kept. Call with
+    _periods_lock held. Returns the evicted periods.
+    """
+    sizes = collections.OrderedDict(
+        (period, dataset_size(ds)) for period, ds in _periods.items())
+    evicted = []
+    while len(sizes) > 1 and sum(sizes.values()) > budget:
+        period, _ = sizes.popitem(last=False)
+        del _periods[period]
+        evicted.append(period)
+    return evicted
+
+
+def dataset(period=None):
+    """
+    The data set of a report period. The default period's is the current
+    one; other periods are loaded on first use and kept, least recently used
+    first out, within WP_PERIOD_CACHE_MB. None, or a period that isn't in
+    WP_PERIODS, gives the current data set.
+    """
+    pinned_dataset = current()
+    if (period is None or period not in periods.available() or
+            (pinned_dataset is not None and pinned_dataset['period'] == period)):
+        return pinned_dataset
+
+    with _periods_lock:
+        if period in _periods:
+            _periods.move_to_end(period)
+            return _periods[period]
+        lock = _loading.setdefault(period, threading.Lock())
+
+    # one thread loads a period, the others wait for it
+    with lock:
+        with _periods_lock:
+            if period in _periods:
+                _periods.move_to_end(period)
+                return _periods[period]
+        start = time.time()
+        frames, version = load_frames(period)
+        result = build_dataset(frames, version, period)
+        budget = float(os.environ.get('WP_PERIOD_CACHE_MB', 256)) * 2 ** 20
+        with _periods_lock:
+            _periods[period] = result
+            evicted = _evict(budget)
+    LOGGER.info('Loaded period %s (%s) in %.3fs', period, version,
+                time.time() - start)
+    if evicted:
+        LOGGER.info('Evicted periods %s', ', '.join(evicted))
+    _changed()
+    return result
+
+
+@contextlib.contextmanager
+def pinned(dataset=None):
+    """Runs the block against `dataset` (default: the current data set)."""
+    previous = getattr(_pinned, 'dataset', None)
+    _pinned.dataset = dataset or _current
+    try:
+        yield _pinned.dataset
+    finally:
+        _pinned.dataset = previous
+
+
+# -----------------------------------------------------------------------
+# Background refresh
+
+def _listen(channel):
+    """A database connection LISTENing on `channel`."""
+    args, kwargs = connection_params()
+    con = connect(*args, **kwargs)
+    try:
+        con.autocommit = True
+        con.cursor().execute('LISTEN "{}"'.format(channel.replace('"', '')))
+    except Exception:
+        con.close()
+        raise
+    return con
+
+
+def _wait_for_notify(con, timeout):
+    """
+    Blocks until a NOTIFY on the LISTENing connection `con` or `timeout`
+    seconds (None: forever). NOTIFYs that arrived since the last call count,
+    and several are taken as one. Returns True when notified.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        con.poll()
+        if con.notifies:
+            del con.notifies[:]
+            return True
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+            return False
+        select.select([con], [], [], remaining)
+
+
+def refresh(on_swap=None):
+    """
+    Reloads from the database and swaps the new data set in if the data
+    changed, then does the same for every other period loaded.
+    on_swap(dataset) is called after the current data set is swapped.
+    Returns True when any new data set was swapped in.
+    """
+    changed = False
+    frames, version = reload()
+    if _current is not None and version == _current['version']:
+        LOGGER.info('Data unchanged (%s)', version)
+    else:
+        dataset = build_dataset(frames, version)
+        swap(dataset)
+        LOGGER.info('Swapped in data version %s', version)
+        if on_swap is not None:
+            on_swap(dataset)
+        changed = True
+
+    with _periods_lock:
+        others = list(_periods)
+    for period in others:
+        frames, version = reload(period)
+        with _periods_lock:
+            old = _periods.get(period)
+        if old is None or version == old['version']:
+            continue  # evicted meanwhile, or unchanged
+        dataset = build_dataset(frames, version, period)
+        with _periods_lock:
+            if period not in _periods:
+                continue
+            _periods[period] = dataset  # keeps its place in the LRU order
+        LOGGER.info('Swapped in data version %s of %s', version, period)
+        _changed()
+        changed = True
+    return changed
+
+
+def start_refresher(interval=None, channel=None, on_swap=None):
+    """
+    Starts a daemon thread that calls `refresh` every `interval` seconds
+    and/or whenever a NOTIFY arrives on the Postgres `channel`.
+    Defaults come from WP_REFRESH_INTERVAL and WP_REFRESH_CHANNEL; returns
+    None without starting anything when neither is set.
+    """
+    if interval is None:
+        interval = float(os.environ.get('WP_REFRESH_INTERVAL', 0)) or None
+    if channel is None:
+        channel = os.environ.get('WP_REFRESH_CHANNEL') or None
+    if interval is None and channel is None:
+        return None
+
+    def run():
+        # one connection stays subscribed, so NOTIFYs sent during a refresh
+        # are queued on it rather than lost
+        con = None
+        retry = False
+        while True:
+            try:
+                # after an error the retry delay is the only wait, and a
+                # reconnect refreshes at once for any NOTIFY sent while
+                # nothing was listening
+                if channel is not None and con is None:
+                    con = _listen(channel)
+                if not retry:
+                    if channel is None:
+                        time.sleep(interval)
+                    else:
+                        _wait_for_notify(con, interval)
+                retry = False
+                refresh(on_swap)
+            except Exception:
+                LOGGER.exception('Data refresh failed')
+                if con is not None:
+                    try:
+                        con.close()
+                    except Exception:
+                        pass
+                    con = None
+                retry = True
+                time.sleep(interval or 60)
+
+    thread = threading.Thread(target=run, name='wp-refresher', daemon=True)
+    thread.start()
+    LOGGER.info('Refreshing data every %s s, channel %s', interval, channel)
+    return thread
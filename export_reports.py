@@ -0,0 +1,211 @@
+"""
+Batch export of the ward profiles as PNG and/or PDF, for the report appendix.
+
+    python export_reports.py [OUTPUT_DIR] [--format png pdf] [--processes N]
+                             [--site DIR] [--chrome PATH] [--force]
+
+Renders the static site (export_static.py) to --site (default site/), serves
+it on a local port and has headless Chrome (or Chromium) open each ward's page
+and save it as OUTPUT_DIR/<ward>.png and/or .pdf (default reports/), with up
+to --processes browsers running at once. The page carries every figure,
+table and map of the ward, so what is saved is what the dashboard shows.
+
+A ward whose page, scripts, images and render settings hash the same as at
+the last run (OUTPUT_DIR/manifest.json) is skipped; --force renders them all.
+The browser is looked up as --chrome, then WP_CHROME, then on the PATH.
+"""
+import argparse
+import functools
+import hashlib
+import http.server
+import json
+import logging
+import os
+import shutil
+import socketserver
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import export_static
+
+LOGGER = logging.getLogger(__name__)
+
+BROWSERS = ['google-chrome', 'google-chrome-stable', 'chromium',
+            'chromium-browser', 'chrome']
+
+# window size, and page time (ms) given to the Dash renderer before capturing
+SETTINGS = {'width': 1280, 'height': 3400, 'wait_ms': 10000}
+
+
+def find_chrome(path=None):
+    path = path or os.environ.get('WP_CHROME')
+    if path:
+        return path
+    for name in BROWSERS:
+        found = shutil.which(name)
+        if found:
+            return found
+    raise SystemExit('No Chrome or Chromium found; pass --chrome or set WP_CHROME')
+
+
+def _files_digest(paths):
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(path.encode())
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
+
+def inputs_digest(site_dir, ward, settings):
+    """
+    Hash of everything a ward's report is rendered from: its page and layout,
+    the shared scripts and stylesheets, the images and the render settings.
+    """
+    shared = []
+    for sub in ('static', 'img', 'hotspots'):
+        for root, _, files in os.walk(os.path.join(site_dir, sub)):
+            shared.extend(os.path.join(root, name) for name in files)
+    ward_dir = os.path.join(site_dir, ward)
+    own = [os.path.join(ward_dir, name) for name in sorted(os.listdir(ward_dir))]
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode())
+    digest.update(_files_digest(own).encode())
+    # keyed on mtime and size too, so files rewritten between exports in the
+    # same process (a new export_static run) are hashed again
+    stats = tuple((path, os.stat(path).st_mtime_ns, os.stat(path).st_size)
+                  for path in sorted(shared))
+    digest.update(_shared_digest(stats).encode())
+    return digest.hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_digest(stats):
+    """Digest of the shared files, given as (path, mtime, size) tuples."""
+    return _files_digest([path for path, _, _ in stats])
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _serve(site_dir):
+    """Serves site_dir on a free local port from a daemon thread."""
+    # SimpleHTTPRequestHandler only takes a directory from Python 3.7 on, so
+    # the paths it resolves against the working directory are moved over
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            path = http.server.SimpleHTTPRequestHandler.translate_path(self, path)
+            return os.path.join(site_dir, os.path.relpath(path, os.getcwd()))
+
+        def log_message(self, *args):
+            pass
+
+    server = _Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def render(chrome, url, path, fmt, settings):
+    """Has headless Chrome save the page at url as path (png or pdf)."""
+    base, ext = os.path.splitext(path)
+    tmp = base + '.tmp' + ext
+    args = [chrome, '--headless', '--disable-gpu', '--no-sandbox',
+            '--hide-scrollbars',
+            '--window-size={},{}'.format(settings['width'], settings['height']),
+            '--virtual-time-budget={}'.format(settings['wait_ms'])]
+    if fmt == 'png':
+        args.append('--screenshot=' + tmp)
+    else:
+        args += ['--print-to-pdf=' + tmp, '--no-pdf-header-footer',
+                 '--print-to-pdf-no-header']
+    subprocess.run(args + [url], check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, timeout=settings['wait_ms'] / 1e3 + 60)
+    os.replace(tmp, path)
+
+
+def export(out_dir, formats, processes=None, site_dir='site', chrome=None,
+           force=False, settings=None, build_site=True):
+    """
+    Writes <out_dir>/<ward>.<format> for every ward whose inputs changed.
+    Returns the list of wards rendered.
+    """
+    chrome = find_chrome(chrome)
+    settings = dict(SETTINGS, **(settings or {}))
+    settings['formats'] = sorted(formats)
+    if build_site:
+        export_static.export(site_dir, processes)
+
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    wards = sorted((name for name in os.listdir(site_dir)
+                    if os.path.exists(os.path.join(site_dir, name, '_dash-layout'))),
+                   key=lambda w: int(w[1:]))
+    todo = {}
+    for ward in wards:
+        digest = inputs_digest(site_dir, ward, settings)
+        outputs = [os.path.join(out_dir, '{}.{}'.format(ward, fmt))
+                   for fmt in formats]
+        if (force or manifest.get(ward) != digest or
+                not all(os.path.exists(path) for path in outputs)):
+            todo[ward] = digest
+    LOGGER.info('%d of %d wards to render', len(todo), len(wards))
+    if not todo:
+        return []
+
+    os.makedirs(out_dir, exist_ok=True)
+    server = _serve(site_dir)
+    base = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    def run(ward):
+        for fmt in formats:
+            render(chrome, base + ward + '/',
+                   os.path.join(out_dir, '{}.{}'.format(ward, fmt)), fmt,
+                   settings)
+        return ward
+
+    # each render is its own browser process; the threads only wait on them
+    rendered = []
+    try:
+        with ThreadPoolExecutor(max_workers=processes or os.cpu_count()) as executor:
+            for ward in executor.map(run, todo):
+                manifest[ward] = todo[ward]
+                rendered.append(ward)
+                LOGGER.info('Rendered %s', ward)
+    finally:
+        server.shutdown()
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return rendered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('out_dir', nargs='?', default='reports')
+    parser.add_argument('--format', nargs='+', choices=['png', 'pdf'],
+                        default=['png', 'pdf'], dest='formats')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='browsers run at once (default: one per core)')
+    parser.add_argument('--site', default='site',
+                        help='where the static site is exported (default site/)')
+    parser.add_argument('--no-build', action='store_true',
+                        help='render the static site already in --site')
+    parser.add_argument('--chrome', help='Chrome or Chromium executable')
+    parser.add_argument('--width', type=int, default=SETTINGS['width'])
+    parser.add_argument('--height', type=int, default=SETTINGS['height'],
+                        help='window height; the PNG is cut at it')
+    parser.add_argument('--wait', type=int, default=SETTINGS['wait_ms'],
+                        help='ms of page time before capturing')
+    parser.add_argument('--force', action='store_true',
+                        help='render every ward, changed or not')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    export(args.out_dir, args.formats, args.processes, args.site, args.chrome,
+           args.force, {'width': args.width, 'height': args.height,
+                        'wait_ms': args.wait},
+           build_site=not args.no_build)
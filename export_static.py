@@ -0,0 +1,189 @@
+"""
+Static site export of every ward profile.
+
+    python export_static.py [OUTPUT_DIR] [--processes N]
+
+Each ward gets a directory (w1/, w2/, ...) with the Dash index page, the
+layout with that ward's callback outputs already filled in (_dash-layout), and
+a dependency list (_dash-dependencies) whose only callback runs in the browser
+and moves to the ward picked in the drop-down. Scripts, stylesheets and images
+are written once under static/ and img/ with content-hash fingerprinted names,
+so the whole directory can be served by any static file server.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+# every ward is rendered by the export itself
+os.environ.setdefault('WP_WARMUP', '0')
+
+import app
+import cache
+import data
+import hotspots
+import images
+
+LOGGER = logging.getLogger(__name__)
+
+NAV_ID = 'static-nav'
+
+# the only callback of the exported pages: pick a ward -> go to its page
+NAV_SCRIPT = '''<script>
+window.dash_clientside = window.dash_clientside || {};
+window.dash_clientside.wardprofiles = {
+    navigate: function(value) {
+        if (value && window.location.pathname.indexOf('/' + value + '/') === -1) {
+            window.location.href = '../' + value + '/';
+        }
+        return '';
+    }
+};
+</script>'''
+
+DEPENDENCIES = [{
+    'output': NAV_ID + '.title',
+    'inputs': [{'id': 'ward-dropdown', 'property': 'value'}],
+    'state': [],
+    'clientside_function': {'namespace': 'wardprofiles',
+                            'function_name': 'navigate'}
+}]
+
+
+def _fingerprinted(url, content):
+    name = os.path.basename(url.split('?')[0]) or 'index'
+    base, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(base, hashlib.sha1(content).hexdigest()[:12], ext)
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def export_index(client, out_dir):
+    """
+    The Dash index page with local scripts and stylesheets copied to static/
+    under fingerprinted names, set up to load its layout from its own
+    directory.
+    """
+    app.app.scripts.config.serve_locally = True
+    app.app.css.config.serve_locally = True
+    page = client.get('/').get_data(as_text=True)
+
+    def copy(match):
+        attr, url = match.group(1), match.group(2)
+        content = client.get(url).get_data()
+        name = _fingerprinted(url, content)
+        _write(os.path.join(out_dir, 'static', name), content)
+        return '{}="../static/{}"'.format(attr, name)
+
+    page = re.sub(r'(src|href)="(/[^"]*)"', copy, page)
+
+    def configure(match):
+        config = json.loads(match.group(2))
+        config['requests_pathname_prefix'] = './'
+        return match.group(1) + json.dumps(config) + match.group(3)
+
+    page = re.sub(r'(<script id="_dash-config"[^>]*>)(.*?)(</script>)',
+                  configure, page, flags=re.S)
+    return page.replace('<footer>', '<footer>\n' + NAV_SCRIPT, 1)
+
+
+def export_images(out_dir):
+    """
+    Copies img/ to the same fingerprinted paths the live route uses, and
+    writes the hotspot maps of the default period the pages link to.
+    """
+    for rel in images.index:
+        dest = os.path.join(out_dir, images.url(rel).lstrip('/'))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(os.path.join(images.IMG_DIR, rel), dest)
+
+    grid = data.current()['hotspots']
+    for key in grid['wards'] if grid is not None else []:
+        for zoom in app.tripmap_zooms:
+            _write(os.path.join(out_dir, hotspots.url(grid, key, zoom).lstrip('/')),
+                   hotspots.map_png(grid, key, zoom))
+
+
+def _apply(node, outputs):
+    """Sets the callback outputs on the matching components of the tree."""
+    if isinstance(node, list):
+        for child in node:
+            _apply(child, outputs)
+    elif isinstance(node, dict) and 'props' in node:
+        props = node['props']
+        props.update(outputs.get(props.get('id'), {}))
+        _apply(props.get('children'), outputs)
+
+
+def ward_layout(ward):
+    """
+    app.layout as JSON with every callback output for `ward` applied.
+    """
+    with data.pinned():
+        values = app.render_ward(ward)
+    targets = [output for outputs, _ in app.ward_renderers
+               for output in outputs]
+
+    # the exported pages are of the default period only
+    outputs = {'ward-dropdown': {'value': ward},
+               'period-selector': {'style': {'display': 'none'}}}
+    for (component_id, prop), value in zip(targets, values):
+        value = json.loads(cache.encode(value).decode())
+        if prop in ('src', 'srcSet') and value:
+            # image URLs relative to the ward directory
+            value = re.sub(r'(^|, )({}|{})'.format(images.ROUTE, hotspots.ROUTE),
+                           r'\1..\2', value)
+        outputs.setdefault(component_id, {})[prop] = value
+
+    layout = json.loads(cache.encode(app.app.layout).decode())
+    _apply(layout, outputs)
+    layout['props']['children'].append({
+        'type': 'Div', 'namespace': 'dash_html_components',
+        'props': {'id': NAV_ID, 'style': {'display': 'none'}}
+    })
+    return layout
+
+
+def export_ward(ward, out_dir, index_page):
+    ward_dir = os.path.join(out_dir, ward)
+    _write(os.path.join(ward_dir, 'index.html'), index_page.encode())
+    _write(os.path.join(ward_dir, '_dash-layout'),
+           json.dumps(ward_layout(ward)).encode())
+    _write(os.path.join(ward_dir, '_dash-dependencies'),
+           json.dumps(DEPENDENCIES).encode())
+    return ward
+
+
+def export(out_dir, processes=None):
+    """Writes the static site for every ward to out_dir."""
+    client = app.server.test_client()
+    index_page = export_index(client, out_dir)
+    export_images(out_dir)
+
+    wards = list(app.ward_dict)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for ward in executor.map(export_ward, wards, [out_dir] * len(wards),
+                                 [index_page] * len(wards)):
+            LOGGER.info('Exported %s', ward)
+
+    _write(os.path.join(out_dir, 'index.html'),
+           b'<!DOCTYPE html><meta http-equiv="refresh" content="0; url=w1/">')
+    LOGGER.info('Exported %d wards to %s', len(wards), out_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('out_dir', nargs='?', default='site')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    export(args.out_dir, args.processes)
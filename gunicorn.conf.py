@@ -0,0 +1,36 @@
+"""
+gunicorn settings (see Procfile).
+
+With WP_PRELOAD=1 (the default) the app is imported once in the master: the
+wp_* data is loaded, the ward profiles are built and every figure is encoded
+before forking, so workers share those pages copy-on-write instead of each
+loading and holding their own copy. The master freezes the garbage collector
+before forking so collections in the workers don't write to (and so copy) the
+shared objects. Workers start their own background threads after the fork,
+and reset the metrics the master recorded, labelling their own by pid.
+"""
+import gc
+import os
+
+preload_app = os.environ.get('WP_PRELOAD', '1') != '0'
+
+# read by app.py at import
+os.environ['WP_PRELOAD'] = '1' if preload_app else '0'
+if preload_app:
+    # encoded once in the master, shared by every worker
+    os.environ.setdefault('WP_FIGURE_CACHE', 'eager')
+
+
+def pre_fork(server, worker):
+    # gc.freeze is Python 3.7+
+    if preload_app and hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    import metrics
+    metrics.reset(worker=worker.pid)
+    if preload_app:
+        import app
+        app.start_background()
@@ -0,0 +1,498 @@
+"""
+Hotspot maps of the pick-ups and drop-offs.
+
+`aggregate.py --hotspots` bins the pick-up and drop-off points of a period into
+a density grid per ward (50 m cells over the city's BBOX, below) and saves
+it as <WP_HOTSPOT_DIR>/<period>/hotspots.npz with a content hash, the grid
+version. Here a ward's grid is rasterized to PNG: the whole ward at zoom z is
+256 * 2**z pixels along its longer side, and is also cut into 256-pixel tiles
+(z/x/y) for a map client. The ward is filled in light grey and outlined, from
+its boundary (aggregate.py --boundaries) or else from the footprint of its
+trip ends; cells are coloured on a log scale and the top 20 are ringed, with
+enough padding around the ward that rings at its edge are drawn whole.
+
+Rendered maps and tiles are kept on disk under <WP_TILE_CACHE>/<grid version>/,
+so each is drawn once per version, and served from /hotspots/<grid version>/...
+with a far-future Cache-Control, like the images of images.py. When a period
+has no grid the trip map stays the static JPEG under img/.
+
+    WP_HOTSPOT_DIR=hotspots   where aggregate.py writes the grids
+    WP_TILE_CACHE=tiles       where the rendered maps and tiles are kept
+"""
+import hashlib
+import logging
+import math
+import os
+import shutil
+import struct
+import threading
+import zlib
+
+import flask
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROUTE = '/hotspots/'
+FILENAME = 'hotspots.npz'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# west, south, east and north edges of the grid, in degrees
+BBOX = (-79.64, 43.58, -79.11, 43.86)
+CELL_M = 50
+CELL_LAT = CELL_M / 111320.0
+CELL_LON = CELL_LAT / math.cos(math.radians((BBOX[1] + BBOX[3]) / 2))
+ROWS = int(math.ceil((BBOX[3] - BBOX[1]) / CELL_LAT))
+COLS = int(math.ceil((BBOX[2] - BBOX[0]) / CELL_LON))
+CELLS = ROWS * COLS
+
+TILE = 256
+MAX_ZOOM = 5  # tiles
+MAX_MAP_ZOOM = 3  # whole maps, 2048 pixels across
+TOP = 20
+SPACING = 6  # cells between two of the top hotspots
+MARGIN = 4  # cells around the ward's busiest extent
+CLOSE = 2  # cells the footprint of a ward's trip ends is closed by
+# bump when the drawing changes, so the maps cached and served under the
+# (immutable) grid version URLs are replaced
+RENDERING = 2
+
+# YlOrRd, from few trips to many
+STOPS = [(255, 255, 178), (254, 204, 92), (253, 141, 60), (240, 59, 32),
+         (189, 0, 38)]
+RING = (8, 48, 107)
+FILL = (236, 236, 236)
+OUTLINE = (99, 99, 99)
+
+_lock = threading.Lock()
+_grids = {}  # grid version -> grid
+_loaded = {}  # path -> (mtime, grid)
+
+
+def hotspot_dir():
+    return os.environ.get('WP_HOTSPOT_DIR', os.path.join(BASE_DIR, 'hotspots'))
+
+
+def cache_dir():
+    return os.environ.get('WP_TILE_CACHE', os.path.join(BASE_DIR, 'tiles'))
+
+
+def cells(lon, lat):
+    """Grid cell (row * COLS + col, row 0 north) of each point; -1 outside."""
+    with np.errstate(invalid='ignore'):
+        col = np.floor((np.asarray(lon, dtype=np.float64) - BBOX[0]) / CELL_LON)
+        row = np.floor((BBOX[3] - np.asarray(lat, dtype=np.float64)) / CELL_LAT)
+        inside = (col >= 0) & (col < COLS) & (row >= 0) & (row < ROWS)
+    return np.where(inside, row * COLS + col, -1).astype(np.int64)
+
+
+def rasterize(rings):
+    """
+    Cells whose centre is inside a polygon, as a (ROWS, COLS) bool array.
+    rings: the polygon's rings (outer ones and holes alike, even-odd), each a
+    list of (lon, lat)
+    """
+    mask = np.zeros((ROWS, COLS), dtype=bool)
+    for ring in rings:
+        points = np.asarray(ring, dtype=np.float64)
+        x = (points[:, 0] - BBOX[0]) / CELL_LON
+        y = (BBOX[3] - points[:, 1]) / CELL_LAT
+        c0, c1 = max(int(x.min()), 0), min(int(math.ceil(x.max())), COLS)
+        r0, r1 = max(int(y.min()), 0), min(int(math.ceil(y.max())), ROWS)
+        if c0 >= c1 or r0 >= r1:
+            continue
+        py, px = np.ogrid[r0:r1, c0:c1]
+        py, px = py + 0.5, px + 0.5
+        inside = np.zeros((r1 - r0, c1 - c0), dtype=bool)
+        for x1, y1, x2, y2 in zip(x, y, np.roll(x, -1), np.roll(y, -1)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > py) != (y2 > py)
+            inside ^= crosses & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+        mask[r0:r1, c0:c1] ^= inside
+    return mask
+
+
+def _grow(mask, n):
+    """mask dilated by n cells (a square of 2n + 1)."""
+    for _ in range(n):
+        grown = mask.copy()
+        grown[1:] |= mask[:-1]
+        grown[:-1] |= mask[1:]
+        mask = grown.copy()
+        mask[:, 1:] |= grown[:, :-1]
+        mask[:, :-1] |= grown[:, 1:]
+    return mask
+
+
+def footprint(counts, n=CLOSE):
+    """
+    Cells with trips, closed by n cells, standing in for a ward's boundary
+    when there is none (each end of a trip is binned in its own ward).
+    """
+    padded = np.pad(counts > 0, n, mode='constant')
+    return ~_grow(~_grow(padded, n), n)[n:-n, n:-n]
+
+
+# -----------------------------------------------------------------------
+# Grids
+
+def write(counts, keys, period, directory=None, masks=None):
+    """
+    Saves the hotspot grid of a period.
+    Inputs:
+    counts: array (wards, ROWS, COLS) of points per cell
+    keys: the wards' drop-down values ('w1', ...)
+    masks: array (wards, ROWS, COLS) of the cells inside each ward (see
+    `rasterize`), or None to draw the wards from their trip ends
+
+    Outputs:
+    grid version
+    """
+    arrays = {}
+    digest = hashlib.sha1(period.encode())
+    for i, (key, grid) in enumerate(zip(keys, counts)):
+        mask = None if masks is None else masks[i]
+        rows, cols = np.nonzero(grid if mask is None else (grid > 0) | mask)
+        if not len(rows):
+            continue
+        r0, c0 = max(rows.min() - MARGIN, 0), max(cols.min() - MARGIN, 0)
+        window = (slice(r0, rows.max() + MARGIN + 1),
+                  slice(c0, cols.max() + MARGIN + 1))
+        crop = np.ascontiguousarray(grid[window], dtype=np.uint32)
+        arrays[key] = crop
+        arrays[key + '_origin'] = np.array([r0, c0])
+        digest.update(key.encode())
+        digest.update(arrays[key + '_origin'].tobytes())
+        digest.update(repr(crop.shape).encode())
+        digest.update(crop.tobytes())
+        if mask is not None:
+            arrays[key + '_mask'] = np.packbits(mask[window])
+            digest.update(arrays[key + '_mask'].tobytes())
+    version = digest.hexdigest()[:16]
+
+    directory = os.path.join(directory or hotspot_dir(), period)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, FILENAME)
+    tmp = '{}.{}.tmp.npz'.format(path[:-4], os.getpid())
+    np.savez(tmp, version=np.array(version), **arrays)
+    os.replace(tmp, path)
+    LOGGER.info('Wrote hotspot grid %s of %d wards to %s', version,
+                len(keys), path)
+    prune()
+    return version
+
+
+def _version(saved):
+    """Version a saved grid is served and cached under."""
+    return '{}-{}'.format(saved['version'], RENDERING)
+
+
+def load(period, directory=None):
+    """
+    The hotspot grid of a period, or None when it has none.
+    Outputs:
+    dict with 'version' (the saved grid version and RENDERING) and 'wards'
+    (drop-down value -> {'counts', 'origin', 'mask', 'max', 'top'})
+    """
+    path = os.path.join(directory or hotspot_dir(), period, FILENAME)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _lock:
+        if path in _loaded and _loaded[path][0] == mtime:
+            return _loaded[path][1]
+
+    with np.load(path) as saved:
+        wards = {}
+        for key in saved.files:
+            if key == 'version' or key.endswith(('_origin', '_mask')):
+                continue
+            counts = saved[key]
+            if key + '_mask' in saved.files:
+                mask = np.unpackbits(saved[key + '_mask'])[:counts.size]
+                mask = mask.reshape(counts.shape).astype(bool)
+            else:
+                mask = footprint(counts)
+            wards[key] = {'counts': counts,
+                          'origin': tuple(saved[key + '_origin'].tolist()),
+                          'mask': mask,
+                          'max': int(counts.max()),
+                          'top': top_cells(counts)}
+        grid = {'version': _version(saved), 'wards': wards}
+    with _lock:
+        _loaded[path] = (mtime, grid)
+        _grids[grid['version']] = grid
+    LOGGER.info('Loaded hotspot grid %s of %s', grid['version'], period)
+    return grid
+
+
+def retain(grids):
+    """
+    Serves the `grids` only (those of the data sets held), dropping every
+    other grid loaded since.
+    """
+    global _grids
+    with _lock:
+        _grids = {grid['version']: grid for grid in grids}
+        for path in [p for p, (_, grid) in _loaded.items()
+                     if grid['version'] not in _grids]:
+            del _loaded[path]
+
+
+def top_cells(counts, n=TOP, spacing=SPACING):
+    """
+    (row, col) of the n busiest cells at least `spacing` cells apart, so
+    that one hotspot isn't ringed many times over.
+    """
+    flat = counts.ravel().astype(np.int64)
+    candidates = np.argsort(-flat, kind='stable')[:n * 100]
+    candidates = candidates[flat[candidates] > 0]
+    rows, cols = np.unravel_index(candidates, counts.shape)
+    chosen = []
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        if all(max(abs(row - r), abs(col - c)) >= spacing for r, c in chosen):
+            chosen.append((row, col))
+            if len(chosen) == n:
+                break
+    return np.array(chosen, dtype=np.int64).reshape(-1, 2)
+
+
+def prune(directory=None):
+    """Removes cached maps of grid versions no longer in the hotspot dir."""
+    directory = directory or hotspot_dir()
+    live = set()
+    for period in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, period, FILENAME)
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                live.add(_version(saved))
+    root = cache_dir()
+    for version in os.listdir(root) if os.path.isdir(root) else []:
+        if version not in live:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+# -----------------------------------------------------------------------
+# Rendering
+
+def _layout(ward, zoom):
+    """
+    (scale, pad) of a ward's map at zoom: pixels per cell, and the pixels
+    around the cells, enough for a ring at the edge.
+    """
+    side = TILE * 2 ** zoom
+    cells = float(max(ward['counts'].shape))
+    pad = int(math.ceil(max(6.0, 0.8 * side / cells))) + 3
+    return (side - 2 * pad) / cells, pad
+
+
+def map_size(ward, zoom):
+    """(width, height) in pixels of the whole map of a ward at zoom."""
+    rows, cols = ward['counts'].shape
+    scale, pad = _layout(ward, zoom)
+    return (int(math.ceil(cols * scale)) + 2 * pad,
+            int(math.ceil(rows * scale)) + 2 * pad)
+
+
+def _bins(start, stop, scale, n):
+    """
+    First cell of each pixel in [start, stop) (counted from the first cell,
+    so negative in the padding), plus the end of the last; n (the zero
+    padding) outside the grid.
+    """
+    pixels = np.arange(start, stop + 1)
+    edges = np.floor(pixels / scale).astype(np.int64)
+    return np.where(pixels < 0, n, np.minimum(edges, n))
+
+
+def _inside(mask, y0, x0, height, width, scale):
+    """
+    Whether the centre of each pixel, counted from the first cell, is in the
+    ward: a (height, width) bool array.
+    """
+    rows, cols = mask.shape
+    padded = np.zeros((rows + 1, cols + 1), dtype=bool)
+    padded[:rows, :cols] = mask
+    ys = np.floor((np.arange(y0, y0 + height) + 0.5) / scale).astype(np.int64)
+    xs = np.floor((np.arange(x0, x0 + width) + 0.5) / scale).astype(np.int64)
+    ys[(ys < 0) | (ys > rows)] = rows
+    xs[(xs < 0) | (xs > cols)] = cols
+    return padded[ys[:, None], xs[None, :]]
+
+
+def _palette():
+    t = np.linspace(0, 1, 256)
+    stops = np.linspace(0, 1, len(STOPS))
+    rgb = np.column_stack([np.interp(t, stops, [s[i] for s in STOPS])
+                           for i in range(3)])
+    alpha = 150 + 105 * t
+    return np.column_stack([rgb, alpha]).round().astype(np.uint8)
+
+
+PALETTE = _palette()
+
+
+def render(ward, zoom, x0=0, y0=0, width=None, height=None):
+    """
+    RGBA array of the pixels (x0, y0) to (x0 + width, y0 + height) of a
+    ward's map at zoom; the default is the whole map.
+    """
+    counts = ward['counts'].astype(np.float64)
+    rows, cols = counts.shape
+    scale, pad = _layout(ward, zoom)
+    full_width, full_height = map_size(ward, zoom)
+    width = full_width - x0 if width is None else width
+    height = full_height - y0 if height is None else height
+
+    # sum the cells under each pixel; a pixel within one cell takes its count
+    # (np.add.reduceat), and divide by the cells summed to keep one scale
+    ys = _bins(y0 - pad, y0 - pad + height, scale, rows)
+    xs = _bins(x0 - pad, x0 - pad + width, scale, cols)
+    padded = np.zeros((rows + 1, cols + 1))
+    padded[:rows, :cols] = counts
+    summed = np.add.reduceat(np.add.reduceat(padded, ys, axis=0)[:-1],
+                             xs, axis=1)[:, :-1]
+    area = (np.maximum(np.diff(ys), 1)[:, None] *
+            np.maximum(np.diff(xs), 1)[None, :])
+    density = summed / area
+
+    level = np.log1p(density) / math.log1p(max(ward['max'], 1))
+    colours = PALETTE[np.clip((level * 255).round(), 0, 255).astype(np.intp)]
+
+    # the ward, one pixel wider all round to find its outline at the edges
+    inside = _inside(ward['mask'], y0 - pad - 1, x0 - pad - 1, height + 2,
+                     width + 2, scale)
+    within = inside[1:-1, 1:-1]
+    outline = within & ~np.logical_and.reduce(
+        [inside[dy:dy + height, dx:dx + width]
+         for dy in range(3) for dx in range(3)])
+
+    image = np.zeros((height, width, 4), dtype=np.uint8)
+    image[within] = FILL + (255,)
+    # the cells over the fill, and as they are outside the ward
+    alpha = colours[..., 3:] / 255.0
+    over = colours[..., :3] * alpha + np.array(FILL) * (1 - alpha)
+    busy = density > 0
+    image[busy & within, :3] = over[busy & within].round()
+    image[busy & ~within] = colours[busy & ~within]
+    image[outline] = OUTLINE + (255,)
+
+    # ring the busiest cells, drawing only around each ring
+    radius = max(6.0, 0.8 * scale)
+    for row, col in ward['top']:
+        cy, cx = (row + 0.5) * scale + pad, (col + 0.5) * scale + pad
+        top, bottom = max(int(cy - radius) - 2, y0), min(int(cy + radius) + 3, y0 + height)
+        left, right = max(int(cx - radius) - 2, x0), min(int(cx + radius) + 3, x0 + width)
+        if top >= bottom or left >= right:
+            continue
+        py, px = np.ogrid[top:bottom, left:right]
+        ring = np.abs(np.hypot(py + 0.5 - cy, px + 0.5 - cx) - radius) <= 1.25
+        image[top - y0:bottom - y0, left - x0:right - x0][ring] = RING + (255,)
+    return image
+
+
+def png(image):
+    """PNG bytes of an RGBA array, written with zlib and struct."""
+    height, width = image.shape[:2]
+    # filter type 0 (none) before every scanline
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 4)
+
+    def chunk(tag, body):
+        return (struct.pack('>I', len(body)) + tag + body +
+                struct.pack('>I', zlib.crc32(tag + body) & 0xffffffff))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def _cached(path, draw):
+    """PNG bytes at path under the tile cache, drawn on a miss."""
+    path = os.path.join(cache_dir(), path)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+    content = png(draw())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, path)
+    return content
+
+
+def map_png(grid, key, zoom):
+    """PNG of the whole map of ward `key` at zoom."""
+    ward = grid['wards'][key]
+    return _cached(os.path.join(grid['version'], key, '{}.png'.format(zoom)),
+                   lambda: render(ward, zoom))
+
+
+def tile_png(grid, key, zoom, x, y):
+    """PNG of tile (x, y) of ward `key` at zoom; None past the map's edge."""
+    ward = grid['wards'][key]
+    width, height = map_size(ward, zoom)
+    if x * TILE >= width or y * TILE >= height:
+        return None
+    return _cached(os.path.join(grid['version'], key, str(zoom), str(x),
+                                '{}.png'.format(y)),
+                   lambda: render(ward, zoom, x * TILE, y * TILE, TILE, TILE))
+
+
+# -----------------------------------------------------------------------
+# URLs and route
+
+def url(grid, key, zoom):
+    """URL of the whole map of ward `key` at zoom."""
+    return '{}{}/{}/{}.png'.format(ROUTE, grid['version'], key, zoom)
+
+
+def srcset(grid, key, zooms):
+    """`srcset` value listing the map of ward `key` at each zoom."""
+    return ', '.join('{} {}w'.format(url(grid, key, zoom),
+                                     map_size(grid['wards'][key], zoom)[0])
+                     for zoom in zooms)
+
+
+def _respond(content):
+    if content is None:
+        flask.abort(404)
+    response = flask.Response(content, mimetype='image/png')
+    # the URL has the grid version, so its content never changes
+    response.set_etag(hashlib.sha1(flask.request.path.encode()).hexdigest()[:16])
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response.make_conditional(flask.request)
+
+
+def _grid(version, key, zoom, max_zoom):
+    grid = _grids.get(version)
+    if grid is None or key not in grid['wards'] or zoom > max_zoom:
+        flask.abort(404)
+    return grid
+
+
+def serve_map(version, key, zoom):
+    grid = _grid(version, key, zoom, MAX_MAP_ZOOM)
+    return _respond(map_png(grid, key, zoom))
+
+
+def serve_tile(version, key, zoom, x, y):
+    grid = _grid(version, key, zoom, MAX_ZOOM)
+    return _respond(tile_png(grid, key, zoom, x, y))
+
+
+def register(server):
+    """Adds the hotspot map and tile routes to the Flask server."""
+    server.add_url_rule(ROUTE + '<version>/<key>/<int:zoom>.png',
+                        'wp_hotspot_map', serve_map)
+    server.add_url_rule(ROUTE + '<version>/<key>/<int:zoom>/<int:x>/<int:y>.png',
+                        'wp_hotspot_tile', serve_tile)
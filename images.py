@@ -0,0 +1,108 @@
+"""
+Static image route for the trip maps and inset icons.
+
+Images under img/ are served from content-hash fingerprinted URLs
+(/img/<digest>/<path>) with a strong ETag and a far-future Cache-Control, so
+the callbacks only send the URL and the browser caches the bytes. Resized
+variants built by build_images.py are listed in img/variants/manifest.json and
+offered through `srcset`.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+
+import flask
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img')
+VARIANTS_MANIFEST = os.path.join(IMG_DIR, 'variants', 'manifest.json')
+ROUTE = '/img/'
+
+# fingerprinted URLs never change content, so they can be cached for a year
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# not in every system's mime.types
+mimetypes.add_type('image/webp', '.webp')
+
+
+def fingerprint(path):
+    """Short content hash of the file at path."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def build_index(img_dir=IMG_DIR):
+    """
+    Fingerprints every file under img_dir.
+    Returns a dict of relative path ('inset/inset_w1.png') -> digest.
+    """
+    index = {}
+    for root, _, files in os.walk(img_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if path == VARIANTS_MANIFEST:
+                continue
+            rel = os.path.relpath(path, img_dir).replace(os.sep, '/')
+            index[rel] = fingerprint(path)
+    return index
+
+
+def load_variants():
+    """
+    Variants of each source image from the build_images.py manifest.
+    Returns a dict of relative path -> [{'path', 'width', 'type'}, ...], empty
+    when the variants haven't been built.
+    """
+    try:
+        with open(VARIANTS_MANIFEST) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {rel: entry['variants'] for rel, entry in manifest.items()
+            if entry['source'] == index.get(rel)}
+
+
+index = build_index()
+variants = load_variants()
+
+
+def url(rel):
+    """Fingerprinted URL of the image at the relative path rel."""
+    return '{}{}/{}'.format(ROUTE, index[rel], rel)
+
+
+def srcset(rel, mimetype):
+    """
+    `srcset` value listing the variants of rel in the given format, e.g.
+    '/img/<digest>/variants/w1-tripmap-480.webp 480w, ...', or None when
+    there are none.
+    """
+    candidates = [v for v in variants.get(rel, [])
+                  if v['type'] == mimetype and v['path'] in index]
+    if not candidates:
+        return None
+    return ', '.join('{} {}w'.format(url(v['path']), v['width'])
+                     for v in sorted(candidates, key=lambda v: v['width']))
+
+
+def serve(digest, filename):
+    if filename not in index:
+        flask.abort(404)
+    if digest != index[filename]:
+        # stale fingerprint from an old page, point it at the current file
+        return flask.redirect(url(filename))
+
+    with open(os.path.join(IMG_DIR, filename), 'rb') as f:
+        response = flask.Response(f.read(),
+                                  mimetype=mimetypes.guess_type(filename)[0])
+    response.set_etag(digest)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response.make_conditional(flask.request)
+
+
+def register(server):
+    """Adds the image route to the Flask server."""
+    server.add_url_rule(ROUTE + '<digest>/<path:filename>', 'wp_images', serve)
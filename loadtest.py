@@ -0,0 +1,269 @@
+"""
+Load generator simulating concurrent users of the ward drop-down.
+
+    python loadtest.py [URL] [--users N] [--duration S] [--switches N]
+                       [--think S] [--no-assets] [--save FILE]
+
+Each simulated user runs sessions against a running server (default
+http://127.0.0.1:8050/) until the duration is up: it loads the page (and,
+unless --no-assets, the scripts and stylesheets it links to), then
+_dash-layout and _dash-dependencies, fires the callbacks of the drop-down's
+initial value, and then walks randomly over the wards listed in the layout,
+firing every callback that depends on the drop-down at each step. Every user
+keeps its own connection open, as a browser does.
+
+Reports throughput, p50/p95/p99 latency and errors per kind of request
+(page, asset, layout, dependencies, each callback) and for whole ward switches.
+Only the standard library is needed, so it can run from any machine.
+"""
+import argparse
+import collections
+import gzip
+import http.client
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+DROPDOWN_ID = 'ward-dropdown'
+SWITCH = '(ward switch)'
+
+HEADERS = {'Accept-Encoding': 'gzip', 'User-Agent': 'wp-loadtest'}
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted list."""
+    index = max(0, min(len(values) - 1, int(round(q / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+class Recorder(object):
+    """Latencies and errors per request kind, shared by every user."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def add(self, kind, seconds, ok):
+        with self.lock:
+            self.times[kind].append(seconds)
+            if not ok:
+                self.errors[kind] += 1
+
+
+class User(object):
+    """One simulated browser: a keep-alive connection and a random walk."""
+
+    def __init__(self, url, recorder, args, seed):
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/') + '/'
+        self.recorder = recorder
+        self.args = args
+        self.random = random.Random(seed)
+        self.con = None
+
+    def _connect(self):
+        cls = (http.client.HTTPSConnection if self.scheme == 'https'
+               else http.client.HTTPConnection)
+        self.con = cls(self.netloc, timeout=self.args.timeout)
+
+    def request(self, kind, method, path, body=None):
+        """Sends one request and records it; returns the body, or None."""
+        headers = dict(HEADERS)
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        if not path.startswith('/'):
+            path = self.prefix + path
+        start = time.perf_counter()
+        try:
+            if self.con is None:
+                self._connect()
+            self.con.request(method, path, body=body, headers=headers)
+            response = self.con.getresponse()
+            content = response.read()
+            if response.getheader('Content-Encoding') == 'gzip':
+                content = gzip.decompress(content)
+            ok = response.status == 200
+        except (OSError, EOFError, http.client.HTTPException):
+            # drop the connection, the next request opens a new one
+            if self.con is not None:
+                self.con.close()
+            self.con = None
+            content, ok = None, False
+        self.recorder.add(kind, time.perf_counter() - start, ok)
+        return content if ok else None
+
+    def load_page(self):
+        """
+        Page, assets, layout and dependencies.
+        Returns (wards, initial ward, deps, layout values of the other inputs).
+        """
+        page = self.request('page', 'GET', '')
+        if page is not None and not self.args.no_assets:
+            for url in re.findall(r'(?:src|href)="(/[^"]*)"', page.decode()):
+                self.request('asset', 'GET', url)
+        layout = self.request('layout', 'GET', '_dash-layout')
+        deps = self.request('dependencies', 'GET', '_dash-dependencies')
+        if layout is None or deps is None:
+            return None
+        layout = json.loads(layout.decode())
+        dropdown = _find(layout, DROPDOWN_ID)
+        wards = [option['value'] for option in dropdown.get('options', [])]
+        deps = [dep for dep in json.loads(deps.decode())
+                if any(i['id'] == DROPDOWN_ID for i in dep['inputs'])]
+        # e.g. the report period, left at its initial value
+        values = {i['id']: (_find(layout, i['id']) or {}).get(i['property'])
+                  for dep in deps for i in dep['inputs']}
+        return wards, dropdown.get('value'), deps, values
+
+    def switch(self, deps, ward, values):
+        """Fires every drop-down callback for `ward`, as the renderer does."""
+        start = time.perf_counter()
+        ok = True
+        for dep in deps:
+            body = {'output': dep['output'],
+                    'inputs': [{'id': i['id'], 'property': i['property'],
+                                'value': ward if i['id'] == DROPDOWN_ID
+                                else values.get(i['id'])}
+                               for i in dep['inputs']]}
+            ok = self.request(_label(dep['output']), 'POST',
+                              '_dash-update-component', body) is not None and ok
+        self.recorder.add(SWITCH, time.perf_counter() - start, ok)
+
+    def session(self):
+        loaded = self.load_page()
+        if loaded is None:
+            # the server is down or failing, don't spin
+            time.sleep(1)
+            return
+        wards, ward, deps, values = loaded
+        if ward is not None:
+            self.switch(deps, ward, values)
+        for _ in range(self.args.switches):
+            if self.args.think:
+                time.sleep(self.random.expovariate(1.0 / self.args.think))
+            ward = self.random.choice([w for w in wards if w != ward] or wards)
+            self.switch(deps, ward, values)
+
+    def run(self, deadline, sessions):
+        while time.time() < deadline:
+            self.session()
+            sessions.append(1)
+        if self.con is not None:
+            self.con.close()
+
+
+def _find(node, component_id):
+    """Props of the component `component_id` in a layout tree."""
+    if isinstance(node, list):
+        for child in node:
+            found = _find(child, component_id)
+            if found is not None:
+                return found
+    elif isinstance(node, dict) and 'props' in node:
+        props = node['props']
+        if props.get('id') == component_id:
+            return props
+        return _find(props.get('children'), component_id)
+    return None
+
+
+def _label(output):
+    """First output of a callback, plus how many more, as on /metrics."""
+    if output.startswith('..') and output.endswith('..'):
+        targets = output[2:-2].split('...')
+        return '{}+{}'.format(targets[0], len(targets) - 1)
+    return output
+
+
+def run(url, args):
+    """
+    Runs args.users users for args.duration seconds.
+    Outputs:
+    (dict of request kind -> summary, seconds elapsed, sessions completed)
+    """
+    recorder = Recorder()
+    sessions = []
+    deadline = time.time() + args.duration
+    users = [User(url, recorder, args, seed=i) for i in range(args.users)]
+    threads = [threading.Thread(target=user.run, args=(deadline, sessions),
+                                daemon=True) for user in users]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    results = {}
+    for kind, times in recorder.times.items():
+        times = sorted(times)
+        results[kind] = {
+            'n': len(times),
+            'errors': recorder.errors[kind],
+            'per_s': len(times) / elapsed,
+            'p50_ms': percentile(times, 50) * 1e3,
+            'p95_ms': percentile(times, 95) * 1e3,
+            'p99_ms': percentile(times, 99) * 1e3,
+        }
+    return results, elapsed, len(sessions)
+
+
+def report(results, elapsed, sessions, users):
+    requests = sum(r['n'] for kind, r in results.items() if kind != SWITCH)
+    errors = sum(r['errors'] for kind, r in results.items() if kind != SWITCH)
+    print('{} users, {:.1f}s, {} sessions: {} requests ({:.1f}/s), '
+          '{} errors ({:.2f}%)\n'.format(
+              users, elapsed, sessions, requests, requests / elapsed, errors,
+              100.0 * errors / requests if requests else 0))
+    header = '{:<45} {:>8} {:>8} {:>7} {:>9} {:>9} {:>9}'.format(
+        'request', 'n', 'per s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms')
+    print(header)
+    print('-' * len(header))
+    for kind in sorted(results, key=lambda k: (k == SWITCH, k)):
+        r = results[kind]
+        name = kind if len(kind) <= 45 else kind[:42] + '...'
+        print('{:<45} {:>8} {:>8.1f} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            name, r['n'], r['per_s'], r['errors'],
+            r['p50_ms'], r['p95_ms'], r['p99_ms']))
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:8050/')
+    parser.add_argument('--users', type=int, default=10,
+                        help='concurrent users (default 10)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run (default 30)')
+    parser.add_argument('--switches', type=int, default=10,
+                        help='ward changes per session after the page load '
+                             '(default 10)')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean pause, in seconds, before each ward change '
+                             '(default 0: as fast as possible)')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='request timeout in seconds (default 30)')
+    parser.add_argument('--no-assets', action='store_true',
+                        help="don't fetch the page's scripts and stylesheets")
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as JSON')
+    args = parser.parse_args()
+
+    results, elapsed, sessions = run(args.url, args)
+    errors = report(results, elapsed, sessions, args.users)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'url': args.url, 'users': args.users,
+                       'duration': elapsed, 'sessions': sessions,
+                       'results': results}, f, indent=1, sort_keys=True)
+    sys.exit(1 if errors else 0)
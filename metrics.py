@@ -0,0 +1,210 @@
+"""
+In-process metrics with a Prometheus text endpoint.
+
+Counters and summaries are plain dicts behind one lock. `stage` times a block
+of a callback (lookup, build, encode); stages nest, and a stage's time
+excludes the stages inside it, so the stages of a request add up to its
+callback time. `begin`/`end` bracket one callback request and record its
+stages, total time, response bytes and ward.
+
+The numbers are per process. Under gunicorn each worker calls `reset` after
+the fork, dropping what the master recorded while warming up, and labels its
+samples with its pid as `worker`; a scrape sees the worker that answered it.
+
+    GET /metrics    (disable with WP_METRICS=0)
+"""
+import collections
+import contextlib
+import threading
+import time
+
+import flask
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+HELP = collections.OrderedDict([
+    ('wp_http_requests_total', ('counter', 'HTTP requests by endpoint and status')),
+    ('wp_http_request_seconds', ('histogram', 'HTTP request time by endpoint')),
+    ('wp_callback_requests_total', ('counter', 'Ward callback requests by callback and ward')),
+    ('wp_callback_seconds', ('histogram', 'Ward callback time by callback')),
+    ('wp_callback_stage_seconds', ('summary', 'Ward callback time by callback and stage')),
+    ('wp_callback_response_bytes', ('summary', 'Ward callback response size by callback')),
+    ('wp_figure_cache_hits_total', ('counter', 'Figure cache hits')),
+    ('wp_figure_cache_misses_total', ('counter', 'Figure cache misses')),
+    ('wp_response_cache_hits_total', ('counter', 'Callback response cache hits')),
+    ('wp_response_cache_misses_total', ('counter', 'Callback response cache misses')),
+    ('wp_callback_not_modified_total', ('counter', 'Callback requests answered with 304')),
+    ('wp_data_version_info', ('gauge', 'Data version currently served')),
+])
+
+_lock = threading.Lock()
+_counters = collections.defaultdict(float)  # (name, labels) -> value
+_summaries = collections.defaultdict(lambda: [0, 0.0])  # -> [count, sum]
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf]
+_gauges = {}
+_local = threading.local()
+_wards = frozenset()  # ward label values; any other ward is labelled 'other'
+_constant = ()  # labels added to every sample, e.g. (('worker', pid),)
+
+
+def reset(worker=None):
+    """
+    Drops the counters, summaries and histograms recorded so far (gauges are
+    kept), and labels every sample from now on with `worker`, if given.
+    """
+    global _constant
+    with _lock:
+        _counters.clear()
+        _summaries.clear()
+        _histograms.clear()
+        _constant = (('worker', worker),) if worker is not None else ()
+
+
+def inc(name, labels=(), value=1):
+    with _lock:
+        _counters[(name, labels)] += value
+
+
+def summary(name, labels, value):
+    with _lock:
+        entry = _summaries[(name, labels)]
+        entry[0] += 1
+        entry[1] += value
+
+
+def histogram(name, labels, value):
+    with _lock:
+        counts = _histograms.setdefault((name, labels), [0] * (len(BUCKETS) + 1))
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        entry = _summaries[(name, labels)]
+        entry[0] += 1
+        entry[1] += value
+
+
+def gauge(name, labels, value):
+    with _lock:
+        for key in [key for key in _gauges if key[0] == name]:
+            del _gauges[key]
+        _gauges[(name, labels)] = value
+
+
+# -----------------------------------------------------------------------
+# Callback stages
+
+def begin():
+    """Starts timing the stages of a callback request on this thread."""
+    _local.stages = {}
+    _local.children = []
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times a block as `name`, excluding any stages nested inside it."""
+    if not hasattr(_local, 'children'):
+        begin()
+    start = time.perf_counter()
+    _local.children.append(0.0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = _local.children.pop()
+        if _local.children:
+            _local.children[-1] += elapsed
+        _local.stages[name] = _local.stages.get(name, 0.0) + elapsed - nested
+
+
+def end(callback, ward, nbytes, seconds):
+    """Records a finished callback request begun with `begin`."""
+    stages = getattr(_local, 'stages', {})
+    # the ward comes from the request, so unknown values share one label
+    if not isinstance(ward, str) or ward not in _wards:
+        ward = 'other'
+    inc('wp_callback_requests_total', (('callback', callback), ('ward', ward)))
+    histogram('wp_callback_seconds', (('callback', callback),), seconds)
+    summary('wp_callback_response_bytes', (('callback', callback),), nbytes)
+    for name, value in stages.items():
+        summary('wp_callback_stage_seconds',
+                (('callback', callback), ('stage', name)), value)
+    begin()
+
+
+# -----------------------------------------------------------------------
+# Exposition
+
+def _labels(labels, extra=()):
+    labels = _constant + tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels) + '}'
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        summaries = {k: list(v) for k, v in _summaries.items()}
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        gauges = dict(_gauges)
+
+    lines = []
+    for name, (kind, text) in HELP.items():
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind in ('counter', 'gauge'):
+            values = counters if kind == 'counter' else gauges
+            for (n, labels), value in sorted(values.items()):
+                if n == name:
+                    lines.append('{}{} {}'.format(name, _labels(labels), value))
+        if kind == 'histogram':
+            for (n, labels), counts in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels, [('le', bound)]), cumulative))
+        if kind in ('summary', 'histogram'):
+            for (n, labels), (count, total) in sorted(summaries.items()):
+                if n == name:
+                    lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+                    lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def serve():
+    return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def register(server, route='/metrics', wards=()):
+    """
+    Times every request and adds the metrics endpoint to the server.
+    wards: the wards recorded under their own label
+    """
+    global _wards
+    _wards = frozenset(wards)
+
+    @server.before_request
+    def start_timer():
+        flask.g.wp_request_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = getattr(flask.g, 'wp_request_start', None)
+        if start is not None:
+            endpoint = flask.request.endpoint or 'unmatched'
+            histogram('wp_http_request_seconds', (('endpoint', endpoint),),
+                      time.perf_counter() - start)
+            inc('wp_http_requests_total', (('endpoint', endpoint),
+                                           ('status', response.status_code)))
+        return response
+
+    server.add_url_rule(route, 'wp_metrics', serve)
@@ -0,0 +1,69 @@
+"""
+Report periods.
+
+Each period is a month ('2018-09') with its own copy of the wp_* tables. The
+September 2018 report reads the original tables (cnangini.wp_vkt); later
+periods read the same tables suffixed with the month (cnangini.wp_vkt_201903),
+CSV fixtures from a subdirectory named after the month (fixtures/201903/) and
+keep their own snapshot. Growth is reported against the same month two years
+earlier.
+
+    WP_PERIODS=2018-09,2019-03    periods offered; the latest is the default
+"""
+import datetime
+import os
+
+ORIGINAL = '2018-09'
+
+# AP style, as used in the report
+MONTHS = ['Jan.', 'Feb.', 'March', 'April', 'May', 'June', 'July', 'Aug.',
+          'Sept', 'Oct.', 'Nov.', 'Dec.']
+
+
+def _date(period):
+    return datetime.datetime.strptime(period, '%Y-%m')
+
+
+def available():
+    """The periods in WP_PERIODS, oldest first."""
+    value = os.environ.get('WP_PERIODS', ORIGINAL)
+    periods = sorted(set(p.strip() for p in value.split(',') if p.strip()))
+    for period in periods:
+        _date(period)  # ValueError on a malformed period
+    return periods
+
+
+def default():
+    return available()[-1]
+
+
+def label(period):
+    """'2018-09' -> 'September 2018'"""
+    return _date(period).strftime('%B %Y')
+
+
+def month(period):
+    """'2018-09' -> 'September'"""
+    return _date(period).strftime('%B')
+
+
+def short(period):
+    """'2018-09' -> 'Sept 2018'"""
+    date = _date(period)
+    return '{} {}'.format(MONTHS[date.month - 1], date.year)
+
+
+def growth_base(period):
+    """The period growth is measured from: '2018-09' -> '2016-09'"""
+    date = _date(period)
+    return '{:04d}-{:02d}'.format(date.year - 2, date.month)
+
+
+def suffix(period):
+    """'' for the original period, else the month ('201903')."""
+    return '' if period == ORIGINAL else period.replace('-', '')
+
+
+def table(name, period):
+    """'cnangini.wp_vkt' -> 'cnangini.wp_vkt_201903'"""
+    return name + '_' + suffix(period) if suffix(period) else name
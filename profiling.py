@@ -0,0 +1,129 @@
+"""
+Opt-in profiling of live requests.
+
+A sampled fraction of requests, and any request carrying the admin header
+with the right token, runs under cProfile. Each profile is written to its own
+pstats file named after the callback and ward (or endpoint), e.g.
+
+    profiles/20190301-142512-8412-3-ward-title.children+26-w7.prof
+
+which `python -m pstats`, snakeviz or flameprof (flame graphs) can open.
+Only one request is profiled at a time; others go through unprofiled. When
+neither setting is given no hooks are installed, so it costs nothing.
+
+    WP_PROFILE_RATE=0.01      profile 1% of requests
+    WP_PROFILE_TOKEN=<secret> profile requests sent with X-WP-Profile: <secret>
+    WP_PROFILE_DIR=profiles   where the files go
+    WP_PROFILE_KEEP=200       most .prof files kept; the oldest are deleted
+"""
+import cProfile
+import hmac
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import flask
+
+import cache
+
+LOGGER = logging.getLogger(__name__)
+
+HEADER = 'X-WP-Profile'
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+DEFAULT_KEEP = 200
+
+_lock = threading.Lock()  # held by the request being profiled
+_count = itertools.count()
+
+
+def _tags():
+    """(callback label, ward) of a callback request, else (endpoint, '-')."""
+    body = flask.request.get_json(silent=True)
+    if isinstance(body, dict) and 'output' in body:
+        wards = [i.get('value') for i in body.get('inputs', [])]
+        return (cache.callback_label(body['output']),
+                '-'.join(str(w) for w in wards) or '-')
+    return flask.request.endpoint or 'unmatched', '-'
+
+
+def _filename(callback, ward):
+    name = '{}-{}-{}-{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                        os.getpid(), next(_count), callback,
+                                        ward)
+    return re.sub(r'[^\w.+-]', '_', name)
+
+
+def _prune(directory, keep):
+    """Deletes all but the `keep` newest .prof files in `directory`."""
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.endswith('.prof')]
+    if len(paths) <= keep:
+        return
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:len(paths) - keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # removed by another worker
+
+
+def register(server, rate=None, token=None, directory=None, keep=None):
+    """
+    Profiles a fraction `rate` of the server's requests, and those sent with
+    the X-WP-Profile: `token` header, keeping the `keep` newest profiles.
+    Defaults come from WP_PROFILE_RATE, WP_PROFILE_TOKEN, WP_PROFILE_DIR and
+    WP_PROFILE_KEEP; does nothing when rate and token are both unset.
+    """
+    if rate is None:
+        rate = float(os.environ.get('WP_PROFILE_RATE', 0))
+    if token is None:
+        token = os.environ.get('WP_PROFILE_TOKEN') or None
+    if directory is None:
+        directory = os.environ.get('WP_PROFILE_DIR', DEFAULT_DIR)
+    if keep is None:
+        keep = int(os.environ.get('WP_PROFILE_KEEP', DEFAULT_KEEP))
+    if not rate and token is None:
+        return None
+
+    @server.before_request
+    def start_profile():
+        # as bytes: compare_digest rejects str with non-ASCII characters
+        requested = token is not None and hmac.compare_digest(
+            flask.request.headers.get(HEADER, '').encode('utf-8'),
+            token.encode('utf-8'))
+        if not requested and random.random() >= rate:
+            return None
+        if not _lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        flask.g.wp_profile = (profile, time.perf_counter())
+        profile.enable()
+
+    @server.teardown_request
+    def stop_profile(exc):
+        started = flask.g.pop('wp_profile', None)
+        if started is None:
+            return
+        profile, start = started
+        try:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            callback, ward = _tags()
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, _filename(callback, ward))
+            profile.dump_stats(path)
+            _prune(directory, keep)
+            LOGGER.info('Profiled %s (%s) in %.1f ms: %s', callback, ward,
+                        elapsed * 1e3, path)
+        except Exception:
+            LOGGER.exception('Could not write profile')
+        finally:
+            _lock.release()
+
+    LOGGER.info('Profiling %g of requests%s to %s', rate,
+                ' and on request' if token is not None else '', directory)
+    return start_profile, stop_profile
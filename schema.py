@@ -0,0 +1,167 @@
+"""
+Declared schema of the wp_* tables.
+
+Lists, per frame, the source table and only the columns the dashboard uses,
+with compact dtypes. `query` generates the SELECT for a table and `apply`
+validates a loaded frame against the schema and casts it, raising SchemaError
+on a missing column or a value that doesn't fit its dtype, so schema drift
+shows up at load time instead of as a callback exception.
+
+The two destination tables are read by position (ward, N destinations, N
+trip counts, N fractions, where N is taken from the width of the table), as
+their column names aren't relied on, and so is wp_growth, whose columns are
+named after the months compared (Sept2016, Sept2018); they are read as
+'before' and 'after'.
+"""
+import collections
+
+import numpy as np
+import pandas as pd
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _numbered(prefix, dtype, n=5):
+    return [('{}{}'.format(prefix, i), dtype) for i in range(1, n + 1)]
+
+
+def _dest_columns(n=5):
+    return ([('ward', 'category')] + _numbered('dest', 'category', n) +
+            # float, as a ward with fewer than n destinations has NULL trips
+            # in its empty slots; store.dest_long drops those and casts to int
+            _numbered('trips', 'float64', n) + _numbered('pct', 'float32', n))
+
+
+WARDS = ['w{}'.format(i) for i in range(1, 26)]
+
+# frame name -> {'table', 'columns': [(name, dtype)], 'positions', 'destinations'}
+# 'positions': the first n columns are matched by position, not by name
+# 'destinations': the positional columns are _dest_columns(n), n read off the
+# table; 'columns' lists them for the usual top 5
+SCHEMA = collections.OrderedDict([
+    ('df_rank', {
+        'table': 'cnangini.wp_avg_daily_trips',
+        'columns': [('ward', 'int16'), ('avg trips/day', 'int32'),
+                    ('y', 'float32')]}),
+    ('df_vkt', {
+        'table': 'cnangini.wp_vkt',
+        'columns': [('ward', 'int16'), ('prop_ptc_traffic', 'float32'),
+                    ('y', 'float32')]}),
+    ('df_pop', {
+        'table': 'cnangini.wp_pop',
+        'columns': [('ward', 'int16'), ('pop', 'int32'), ('y', 'float32')]}),
+    ('df_popd', {
+        'table': 'cnangini.wp_popdensity',
+        'columns': [('ward', 'int16'), ('pop_density', 'float32'),
+                    ('y', 'float32')]}),
+    ('df_growth', {
+        'table': 'cnangini.wp_growth',
+        'positions': 4,
+        'columns': [('ward', 'category'), ('before', 'float32'),
+                    ('after', 'float32'), ('percent_change', 'float32')]}),
+    ('df_dow_ts', {
+        'table': 'cnangini.wp_dow_timeseries',
+        'columns': [(col, 'float32') for col in ['city'] + WARDS]}),
+    ('df_busiest_pudo_info', {
+        'table': 'cnangini.wp_busiest_pudo_info',
+        'columns': [('ward', 'category'), ('div1', 'category'),
+                    ('div2', 'category'), ('Observations', 'category'),
+                    ('Pickups', 'int32'), ('Dropoffs', 'int32')]}),
+    ('df_top5_dest', {
+        'table': 'cnangini.wp_top5_dest',
+        'positions': 16,
+        'destinations': True,
+        'columns': _dest_columns() + [('Observations', 'category')]}),
+    ('df_busiest_top5_dest', {
+        'table': 'cnangini.wp_busiest_top5_dest',
+        'positions': 16,
+        'destinations': True,
+        'columns': _dest_columns()}),
+])
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def query(name, table=None):
+    """
+    SELECT statement for the frame `name`, from its table or else `table`
+    (the same table for another period).
+    """
+    spec = SCHEMA[name]
+    table = table or spec['table']
+    if spec.get('positions'):
+        return 'SELECT * FROM {}'.format(table)
+    return 'SELECT {} FROM {}'.format(
+        ', '.join(_quote(col) for col, _ in spec['columns']), table)
+
+
+def _cast(name, col, series, dtype):
+    if str(series.dtype) == dtype:
+        return series
+    if dtype == 'category':
+        return series.astype('category')
+    try:
+        values = series
+        if not pd.api.types.is_numeric_dtype(values):
+            # e.g. wp_vkt.prop_ptc_traffic, which is stored as text
+            values = pd.to_numeric(values, errors='raise')
+        cast = values.astype(dtype)
+    except (TypeError, ValueError) as e:
+        raise SchemaError('{}.{}: cannot read as {}: {}'.format(
+            SCHEMA[name]['table'], col, dtype, e))
+    if np.dtype(dtype).kind in 'iu' and not (cast == values).all():
+        raise SchemaError('{}.{}: values don\'t fit {}'.format(
+            SCHEMA[name]['table'], col, dtype))
+    return cast
+
+
+def _layout(name, df):
+    """
+    (columns, positions) of the frame `name` as loaded in df: the declared
+    ones, or for a destination table as many destinations as df has.
+    """
+    spec = SCHEMA[name]
+    columns = spec['columns']
+    positions = spec.get('positions', 0)
+    if not spec.get('destinations'):
+        return columns, positions
+    # the named columns that follow the positional ones, e.g. Observations
+    extra = columns[positions:]
+    width = len([col for col in df.columns
+                 if col not in set(col for col, _ in extra)]) - 1
+    if width < 3 or width % 3:
+        raise SchemaError('{}: expected a ward column and N destination, trip '
+                          'and fraction columns, got {} columns'.format(
+                              spec['table'], len(df.columns)))
+    return _dest_columns(width // 3) + extra, width + 1
+
+
+def apply(name, df):
+    """
+    Validates the frame `name` against its schema.
+    Outputs:
+    DataFrame with only the declared columns, in the declared dtypes
+    """
+    spec = SCHEMA[name]
+    columns, positions = _layout(name, df)
+    names = [col for col, _ in columns]
+    if positions:
+        if len(df.columns) < positions:
+            raise SchemaError('{}: expected at least {} columns, got {}'.format(
+                spec['table'], positions, len(df.columns)))
+        df = df.rename(columns=dict(zip(df.columns[:positions],
+                                        names[:positions])))
+
+    missing = [col for col in names if col not in df.columns]
+    if missing:
+        raise SchemaError('{}: missing columns {}'.format(spec['table'], missing))
+
+    return pd.DataFrame(
+        collections.OrderedDict(
+            (col, _cast(name, col, df[col], dtype))
+            for col, dtype in columns),
+        index=df.index)
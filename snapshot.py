@@ -0,0 +1,143 @@
+"""
+Local columnar snapshot of the wp_* frames.
+
+Each column is written as its own .npy file under <snapshot dir>/<version>/,
+and manifest.json in the snapshot dir points at the current version. Numeric
+columns are read memory-mapped, but pandas copies them into the frames, so
+each process still holds its own copy (share one with WP_PRELOAD under
+gunicorn); what the snapshot saves is the query and the parsing. Text columns
+are stored as pickled object arrays. Workers boot from the snapshot and only
+go to Postgres when it is missing or stale (see data.load_frames). Each report period has its own
+snapshot dir, <WP_SNAPSHOT_DIR>/<period>/.
+
+    python snapshot.py        # refresh every period's snapshot from the database
+"""
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+LOGGER = logging.getLogger(__name__)
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'snapshot')
+
+
+def snapshot_dir():
+    return os.environ.get('WP_SNAPSHOT_DIR', DEFAULT_DIR)
+
+
+def _save(path, values):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, values, allow_pickle=values.dtype == object)
+    os.replace(tmp, path)
+
+
+def _load(path, dtype):
+    if dtype == 'object':
+        return np.load(path, allow_pickle=True)
+    return np.load(path, mmap_mode='r')
+
+
+def write(frames, version, directory=None, expires=True):
+    """
+    Writes frames (dict of name -> DataFrame) as snapshot `version` and
+    points the manifest at it. Older versions are removed.
+    expires: False for frames that don't come from the database (aggregate.py),
+    which WP_SNAPSHOT_MAX_AGE would otherwise send to the database once stale
+    """
+    directory = directory or snapshot_dir()
+    version_dir = os.path.join(directory, version)
+    os.makedirs(version_dir, exist_ok=True)
+
+    tables = {}
+    for name, df in frames.items():
+        columns = []
+        for i, col in enumerate(df.columns):
+            filename = '{}.{}.npy'.format(name, i)
+            values = np.asarray(df[col])
+            _save(os.path.join(version_dir, filename), values)
+            columns.append({'name': col, 'file': filename,
+                            'dtype': str(values.dtype)})
+        index = np.asarray(df.index)
+        _save(os.path.join(version_dir, name + '.index.npy'), index)
+        tables[name] = {'columns': columns, 'rows': len(df),
+                        'index': {'file': name + '.index.npy',
+                                  'dtype': str(index.dtype)}}
+
+    manifest = {'format': FORMAT, 'version': version, 'created': time.time(),
+                'expires': expires, 'tables': tables}
+    path = os.path.join(directory, MANIFEST)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+
+    for entry in os.listdir(directory):
+        old = os.path.join(directory, entry)
+        if entry != version and os.path.isdir(old):
+            shutil.rmtree(old, ignore_errors=True)
+
+    LOGGER.info('Wrote snapshot %s to %s', version, directory)
+    return manifest
+
+
+def read_manifest(directory=None):
+    """The current manifest, or None when there is no usable snapshot."""
+    path = os.path.join(directory or snapshot_dir(), MANIFEST)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('format') != FORMAT:
+        return None
+    return manifest
+
+
+def read(manifest, directory=None):
+    """
+    Loads the frames of a manifest returned by `read_manifest`. The frames
+    are copies in memory, not views of the memory-mapped files.
+    """
+    version_dir = os.path.join(directory or snapshot_dir(), manifest['version'])
+    frames = {}
+    for name, table in manifest['tables'].items():
+        index = _load(os.path.join(version_dir, table['index']['file']),
+                      table['index']['dtype'])
+        frames[name] = pd.DataFrame(
+            {col['name']: _load(os.path.join(version_dir, col['file']),
+                                col['dtype'])
+             for col in table['columns']},
+            index=pd.Index(index),
+            columns=[col['name'] for col in table['columns']])
+    return frames
+
+
+def is_fresh(manifest, names, max_age):
+    """
+    True when the manifest covers exactly `names` and is younger than
+    max_age seconds (None means it never expires), or was written with
+    expires=False.
+    """
+    if set(manifest['tables']) != set(names):
+        return False
+    if max_age is None or not manifest.get('expires', True):
+        return True
+    return time.time() - manifest['created'] < max_age
+
+
+if __name__ == '__main__':
+    import data
+    import periods
+    logging.basicConfig(level=logging.INFO)
+    for period in periods.available():
+        frames = data.load_tables(period=period)
+        write(frames, data.data_version(frames, period), data.snapshot_dir(period))
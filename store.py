@@ -0,0 +1,152 @@
+"""
+Ward profile store.
+
+The wp_* tables are keyed inconsistently (``wp_avg_daily_trips`` and friends
+use integer wards, ``wp_growth`` and the destination tables use 'w1'-style
+strings) and the callbacks used to look every value up with a boolean mask over
+the whole frame. ``build_profiles`` flattens the nine frames once at load time
+into one record per integer ward id, plus a record for the city, so that a
+callback only does dict lookups. The number line figures get their points as
+ready-made lists too.
+"""
+import numpy as np
+import pandas as pd
+
+CITY = 'city'
+
+
+def ward_id(value):
+    """
+    Normalises a ward key to the integer ward id.
+    Accepts the drop-down value ('w7'), a bare number (7, '7', numpy ints) or
+    'city', which is returned unchanged.
+    """
+    if isinstance(value, str):
+        if value == CITY:
+            return CITY
+        if value[:1] == 'w':
+            value = value[1:]
+    return int(value)
+
+
+def _native(series):
+    """
+    The values of a column as native Python types. float32 values go through
+    their shortest repr, so 3.8 stays 3.8 rather than becoming
+    3.799999952316284 in the stats text and the figure JSON.
+    """
+    if series.dtype == np.float32:
+        return [float(str(v)) for v in series.values]
+    return series.tolist()
+
+
+def _records(df, columns):
+    """
+    Maps ward id -> {field: value} for the given {field: column} pairs of df.
+    Values are converted to native Python types; when a ward appears more than
+    once the first row wins, as with the old `.values[0]` lookups.
+    """
+    keys = [ward_id(w) for w in df['ward'].tolist()]
+    values = {field: _native(df[col]) for field, col in columns.items()}
+    records = {}
+    for i, key in enumerate(keys):
+        if key not in records:
+            records[key] = {field: vals[i] for field, vals in values.items()}
+    return records
+
+
+def dest_count(df):
+    """Number of destinations (N) of a destination table."""
+    return sum(1 for col in df.columns if str(col).startswith('dest'))
+
+
+def dest_long(df):
+    """
+    Reshapes a destination table from wide (a row per ward: the ward, then N
+    destination, N trip and N fraction columns) to long, for every ward at
+    once. Destinations left empty are dropped.
+
+    Outputs:
+    DataFrame with 'ward' (integer ward id), 'rank' (1 to N), 'destination',
+    'trips' and 'pct', in the order of the rows and then of the rank
+    """
+    n = dest_count(df)
+
+    def block(prefix):
+        cols = ['{}{}'.format(prefix, i) for i in range(1, n + 1)]
+        values = df[cols].values
+        return values.astype(object) if prefix == 'dest' else values
+
+    long = pd.DataFrame({
+        'ward': np.repeat(np.asarray(df['ward'].map(ward_id), dtype=object), n),
+        'rank': np.tile(np.arange(1, n + 1), len(df)),
+        'destination': block('dest').ravel(),
+        'trips': block('trips').ravel(),
+        'pct': block('pct').ravel(),
+    })
+    long = long[long['destination'].notna()].reset_index(drop=True)
+    long['trips'] = long['trips'].astype('int64')
+    return long
+
+
+def _dest_rows(df):
+    """
+    Maps ward id -> list of (destination, trips, fraction) rows, top first.
+    When a ward appears more than once the first row wins, as in `_records`.
+    """
+    long = dest_long(df[~df['ward'].duplicated()])
+    rows = {}
+    for key, row in zip(long['ward'].tolist(),
+                        zip(_native(long['destination']),
+                            _native(long['trips']), _native(long['pct']))):
+        rows.setdefault(key, []).append(row)
+    return rows
+
+
+def build_profiles(df_rank, df_vkt, df_pop, df_popd, df_growth, df_dow_ts,
+                   df_busiest_pudo_info, df_top5_dest, df_busiest_top5_dest):
+    """
+    Builds the ward profile store from the nine wp_* frames.
+
+    Outputs:
+    dict with 'wards' (integer ward id -> record), 'city' (record with the
+    city-wide growth numbers and time of week profile) and 'lines' (field ->
+    {'x', 'y'} points of every ward for the number line figures)
+    """
+    sources = [
+        _records(df_rank, {'avg_trips': 'avg trips/day'}),
+        _records(df_vkt, {'prop_ptc_traffic': 'prop_ptc_traffic'}),
+        _records(df_pop, {'pop': 'pop'}),
+        _records(df_popd, {'pop_density': 'pop_density'}),
+        _records(df_growth, {'growth_before': 'before',
+                             'growth_after': 'after',
+                             'growth_pc': 'percent_change'}),
+        _records(df_busiest_pudo_info, {'busiest_hr': 'div1',
+                                        'busiest_tot': 'div2',
+                                        'busiest_obs': 'Observations',
+                                        'pickups': 'Pickups',
+                                        'dropoffs': 'Dropoffs'}),
+        _records(df_top5_dest, {'top5_obs': 'Observations'}),
+        {key: {'top5_dest': rows}
+         for key, rows in _dest_rows(df_top5_dest).items()},
+        {key: {'busiest_top5_dest': rows}
+         for key, rows in _dest_rows(df_busiest_top5_dest).items()},
+        {ward_id(col): {'dow': _native(df_dow_ts[col])}
+         for col in df_dow_ts.columns
+         if col == CITY or (str(col)[:1] == 'w' and str(col)[1:].isdigit())},
+    ]
+
+    merged = {}
+    for source in sources:
+        for key, rec in source.items():
+            merged.setdefault(key, {}).update(rec)
+
+    city = merged.pop(CITY, {})
+    lines = {
+        field: {'x': _native(df[col]), 'y': _native(df['y'])}
+        for field, df, col in [('avg_trips', df_rank, 'avg trips/day'),
+                               ('prop_ptc_traffic', df_vkt, 'prop_ptc_traffic'),
+                               ('pop', df_pop, 'pop'),
+                               ('pop_density', df_popd, 'pop_density')]
+    }
+    return {'wards': merged, 'city': city, 'lines': lines}
@@ -0,0 +1,11 @@
+"""
+Runs the tests against the CSV fixtures, with the app importable from the
+repository root.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('WP_FIXTURES', os.path.join(ROOT, 'fixtures'))
+os.environ.setdefault('WP_WARMUP', '0')
@@ -0,0 +1,68 @@
+"""
+Checks the ward figures against plotly's validated graph objects.
+
+The render functions in app.py build their traces as plain dicts, which
+plotly.graph_objs would otherwise validate property by property on every
+callback. This builds every figure for every ward, runs each trace through
+the matching graph_objs class (which raises on an unknown property or a bad
+value) and checks that the validated trace encodes to the same JSON as the
+dict. Only the tests import plotly.graph_objs; the app never does.
+
+    python -m pytest tests
+"""
+import json
+
+import plotly.graph_objs as go
+import pytest
+
+import app
+import cache
+import data
+
+FIGURE_RENDERERS = [func for outputs, func in app.ward_renderers
+                    if [prop for _, prop in outputs] == ['figure']]
+
+
+def _json(value):
+    return json.loads(cache.encode(value).decode())
+
+
+def check_trace(trace):
+    """Problems with one trace dict, as a list of strings."""
+    cls = getattr(go, trace.get('type', 'scatter').capitalize(), None)
+    if cls is None:
+        return ['unknown trace type {!r}'.format(trace.get('type'))]
+    try:
+        validated = cls(trace).to_plotly_json()
+    except ValueError as e:
+        return [str(e).strip().splitlines()[0]]
+    expected, actual = _json(validated), _json(trace)
+    return ['{}: {!r} (graph_objs: {!r})'.format(key, actual.get(key),
+                                                 expected.get(key))
+            for key in sorted(set(expected) | set(actual))
+            if expected.get(key) != actual.get(key)]
+
+
+@pytest.mark.parametrize('func', FIGURE_RENDERERS,
+                         ids=[func.__name__ for func in FIGURE_RENDERERS])
+def test_traces_match_graph_objs(func):
+    problems = []
+    with data.pinned():
+        for ward in app.ward_dict:
+            for i, trace in enumerate(func(ward)['data']):
+                problems.extend('{!r} trace {}: {}'.format(ward, i, problem)
+                                for problem in check_trace(trace))
+    assert not problems, '\n'.join(problems)
+
+
+def test_app_does_not_import_graph_objs():
+    # the dict traces are there so the callbacks never go through it
+    import ast
+    with open(app.__file__) as f:
+        tree = ast.parse(f.read())
+    imported = [alias.name for node in ast.walk(tree)
+                if isinstance(node, (ast.Import, ast.ImportFrom))
+                for alias in node.names] + [
+        node.module for node in ast.walk(tree)
+        if isinstance(node, ast.ImportFrom) and node.module]
+    assert not [name for name in imported if 'graph_objs' in name]
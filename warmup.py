@@ -0,0 +1,60 @@
+"""
+Warm-up phase and readiness endpoint.
+
+`run` renders every ward once before the process takes traffic, so no user
+pays for the first build of a ward (plotly validators, figure construction,
+JSON encoding, the figure cache). `/ready` answers 503 until the warm-up has
+finished and 200 afterwards, for the load balancer's health check.
+
+    GET /ready    (WP_WARMUP=0 skips the warm-up and reports ready at once)
+"""
+import logging
+import threading
+import time
+
+import flask
+
+LOGGER = logging.getLogger(__name__)
+
+_ready = threading.Event()
+
+
+def ready():
+    return _ready.is_set()
+
+
+def run(warm):
+    """Calls warm() and marks the process ready once it returns."""
+    start = time.time()
+    try:
+        warm()
+    except Exception:
+        # a cold process still works, it's only slower
+        LOGGER.exception('Warm-up failed')
+    else:
+        LOGGER.info('Warmed up in %.3fs', time.time() - start)
+    _ready.set()
+
+
+def start(warm):
+    """Runs the warm-up on a daemon thread."""
+    thread = threading.Thread(target=run, args=(warm,), name='wp-warmup',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def skip():
+    _ready.set()
+
+
+def serve():
+    if not ready():
+        return flask.Response('warming up\n', status=503, mimetype='text/plain',
+                              headers={'Retry-After': '1'})
+    return flask.Response('ready\n', mimetype='text/plain')
+
+
+def register(server, route='/ready'):
+    """Adds the readiness endpoint to the server."""
+    server.add_url_rule(route, 'wp_ready', serve)